@@ -0,0 +1,122 @@
+"""Provide the conversion of airmonitor API responses into row tuples.
+
+Nothing is set up at import time: the session, logger and diagnostics are
+passed in (see scraper.rowify), so the functions can be imported anywhere,
+e.g. by the benchmark in diagnostics.py.
+"""
+import json
+import logging
+
+from typing import Union, Collection
+
+import requests as req
+import datetime as dt
+
+from diagnostics import Diagnostics  # custom
+
+requestTimeout = 120  # seconds, so a hanging request can't block forever
+
+
+def stringifyID(point: dict, uid: Union[int, str]) -> str:
+    """Take a measurement dictionary and return a hopefully unique string id.
+
+    More precisely, it's a concat of the ordinal begin and end timestamps,
+    station uid and the sensor values.
+
+    Returns the concat of the above mentioned.
+    """
+    # ordinal time for begin (b) and end (e)
+    b = dt.datetime.fromisoformat(point['TBTimestamp']).strftime('%s')
+    e = dt.datetime.fromisoformat(point['TETimestamp']).strftime('%s')
+    # string concat of all sensor labels
+    values = "-".join([str(sens["Scaled"]) for sens in point["Channels"]])
+
+    idString = f"{uid}-{b}-{e}_{values}"  # actual id string
+    return idString
+
+
+def rowify(session: req.Session, diagnostics: Diagnostics, url: str,
+           additional_info: list = [], knownIds: Collection[str] = (),
+           strict: bool = False, logger: logging.Logger = None,
+           timeout: float = requestTimeout) -> list:
+    """Request given url and create list of row-tuples containing the data.
+
+    The fields of the tuple correspond to the ones in the airmonitorSchema.
+    Filled with None if no measurement data is available. Points whose
+    IdString is in knownIds are skipped as duplicates. Per-point events are
+    counted in diagnostics, the rest is logged to logger (default: the one of
+    diagnostics). If strict, failed requests (also non-2xx statuses) raise
+    instead of returning an empty list, to tell them apart from "no data" (a
+    response that is no JSON, as before).
+
+    Returns a list of row tuples.
+    """
+    logger = diagnostics.logger if logger is None else logger
+
+    # print(f"::: [diag] requsted url: {url}")
+    try:
+        response = session.get(url, timeout=timeout)
+        if strict:
+            response.raise_for_status()
+        rawdata = response.json()  # does exactly what you think
+    except json.decoder.JSONDecodeError as err:
+        splits = url.split('/')
+        intvl = f"[{splits[-3]}, {splits[-2]}]"
+        logger.warning("[rowify] No data found for interval %s. "
+                       "Msg: %s.", intvl, err)  # use exc_info=1 for traceback
+        return []  # to be handled later
+
+    fulldata = []
+    genIdStrings = set()  # newly generated IdStrings of this request
+    for point in rawdata:  # iterating over all measured datapoints
+        uid = additional_info[0]
+        idstring = stringifyID(point, uid)  # create unique IdString
+
+        # check for duplicates
+        if idstring not in genIdStrings and idstring not in knownIds:
+            genIdStrings.add(idstring)  # if IdString is unique, keep it
+
+            # first part of data
+            row = [point[i] for i in ["TBTimestamp", "TETimestamp", "Latitude",
+                                      "Longitude", "Altitude"]]
+
+            # Channel part of data
+            channels = point["Channels"]
+            tableChannels = ["AIRPRES", "CO", "HUM", "NO", "NO2", "O3", "SO2",
+                             "PM1", "PM10", "PM2.5", "PARTICLE_COUNT", "TEMP",
+                             "TSP", "VOLTAGE"]
+
+            # dict comprehension to get sensorlabel: sensorchannel pairs
+            channelDict = {ch["SensorLabel"]: ch for ch in channels}
+            channelDictKeys = list(channelDict.keys())
+
+            # count unrecognized channel labels (summarised per station)
+            for cdk in channelDictKeys:
+                if cdk not in tableChannels:
+                    diagnostics.count(uid, "unrecognized channel label", cdk,
+                                      idstring)
+
+            # kind of diagnostics so see, whether all the data fits in nicely
+            if len(tableChannels) != len(channels):
+                diagnostics.count(uid, "channels received/expected",
+                                  f"{len(channels)}/{len(tableChannels)}")
+
+            # creating the actual row
+            for tch in tableChannels:
+                if tch in channelDictKeys:
+                    ch = channelDict[tch]
+                    row = [*row, *[ch["PreScaled"], ch["Slope"], ch["Offset"],
+                                   ch["Scaled"], ch["UnitName"], ch["Status"]]]
+                else:
+                    filler = [None] * 6  # no data -> fill with None
+                    row = [*row, *filler]
+
+            row = tuple([*row, *additional_info, idstring])
+            fulldata.append(row)
+
+        else:
+            diagnostics.count(uid, "duplicate IdString", exemplar=idstring)
+
+    del rawdata[:]  # freeing memory
+
+    return fulldata
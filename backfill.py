@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""A script to find and refetch missing intervals of the airmonitor data.
+
+scraper.py only ever resumes from the latest TBTimestamp of a station, so an
+interval lost on the way (e.g. an API hiccup or a failed insert) stays lost.
+This script finds these gaps for all stations in a single query and requests
+only the missing spans from the airmonitor API.
+"""
+
+import json
+import os
+
+from typing import Optional
+
+import requests as req
+import datetime as dt
+
+import scraper  # custom, sets up logging, clients and the station list
+from query import Query  # custom
+from quality import QualityFlagger  # custom
+
+if scraper.storageBackend != "bigquery":
+    raise RuntimeError("backfill.py needs the bigquery storage backend.")
+
+from scraper import (logger, diagnostics, store, baseURL, rowify, queryThis,
+                     intervalsSince, toLayout, calibrationStaging,
+                     storageLayout, project, dataset_id, table_id)
+
+# backfill settings -----------------------------------------------------------
+gapLookbackDays = 30  # only scan this many days back, None for full history
+gapTolerance = 1.5  # gap if next point starts later than this * point length
+minGapMinutes = 60  # ... but never report gaps shorter than this
+maxGaps = 500  # maximum number of gaps to refetch per run
+# gaps the API had no data for, to not request them on every run again
+triedGapsFile = "airmonitorGaps.json"
+
+
+# functions -------------------------------------------------------------------
+def findGaps(since: dt.datetime = None) -> list:
+    """Find missing spans of all stations with a single query.
+
+    For every point, the end of the previous point (LAG over TBTimestamp) is
+    compared to its begin. If the difference exceeds gapTolerance times the
+    length of the previous point (at least minGapMinutes), the span in
+    between is reported.
+
+    Returns a list of rows with UniqueId, StationName, GapBegin, GapEnd and
+    the IdStrings of the two points bordering the gap.
+    """
+    window = "OVER (PARTITION BY UniqueId ORDER BY TBTimestamp)"
+    lagged = Query(f"UniqueId, StationName, TBTimestamp, IdString, "
+                   f"LAG(TBTimestamp) {window} AS PrevTB, "
+                   f"LAG(TETimestamp) {window} AS PrevTE, "
+                   f"LAG(IdString) {window} AS PrevIdString",
+                   f"`{project}.{dataset_id}.{table_id}`",
+                   WHERE=f"TBTimestamp >= '{since}'" if since else None)
+    gaps = Query(WITHAS=('q', str(lagged)),
+                 SELECT="UniqueId, StationName, PrevTB AS GapBegin, "
+                        "TBTimestamp AS GapEnd, PrevIdString, IdString",
+                 FROM="q",
+                 WHERE=f"TIMESTAMP_DIFF(TBTimestamp, PrevTE, SECOND) > "
+                       f"GREATEST({gapTolerance} * "
+                       f"TIMESTAMP_DIFF(PrevTE, PrevTB, SECOND), "
+                       f"{minGapMinutes * 60})",
+                 ORDERBY="UniqueId, GapBegin")
+
+    return queryThis(gaps)
+
+
+def gapKey(gap) -> str:
+    """Return a string identifying a gap, used in triedGapsFile."""
+    return (f"{gap.get('UniqueId')}/{gap.get('GapBegin').isoformat()}/"
+            f"{gap.get('GapEnd').isoformat()}")
+
+
+def backfill(gap) -> Optional[int]:
+    """Request the data of a single gap and insert it.
+
+    Returns the number of inserted rows, None if a request failed (so the gap
+    has to be tried again).
+    """
+    UniqueId = gap.get('UniqueId')
+    stationName = gap.get('StationName')
+    # the bordering points are already stored, don't insert them twice
+    knownIds = {gap.get('PrevIdString'), gap.get('IdString')}
+    # the rolling state of the scraper is past the gap, start a fresh one
+    flagger = QualityFlagger()
+
+    inserted = 0
+    failed = False
+    end = gap.get('GapEnd') - dt.timedelta(seconds=1)
+    for iv in intervalsSince(gap.get('GapBegin'), end):
+        try:
+            rows = rowify(f"{baseURL}stationdata/{iv}/{UniqueId}",
+                          [UniqueId, stationName], knownIds, strict=True)
+        except req.RequestException as err:  # not "no data", retry later
+            logger.warning("Request for interval [%s, %s] failed, the gap is "
+                           "tried again next run. Msg: %s.", *iv.split('/'),
+                           err)
+            failed = True
+            continue
+
+        if len(rows) > 0:  # if data is returned
+            logger.info("Inserting %s rows for interval [%s, %s].",
+                        len(rows), *iv.split('/'))
+            try:
+                store.insert(toLayout(flagger.flag(rows)))
+            except RuntimeError as err:  # rejected rows, retry the gap
+                logger.error("Inserting interval [%s, %s] failed. Msg: %s",
+                             *iv.split('/'), err)
+                failed = True
+                continue
+            inserted += len(rows)
+            del rows[:]  # freeing memory
+
+    return None if failed else inserted
+
+
+# backfill gaps ---------------------------------------------------------------
+if __name__ == "__main__":
+    triedGaps = []
+    if os.path.exists(triedGapsFile):
+        with open(triedGapsFile, "r") as tg:
+            triedGaps = json.load(tg)
+
+    since = None
+    if gapLookbackDays is not None:
+        since = (dt.datetime.now(dt.timezone.utc) -
+                 dt.timedelta(days=gapLookbackDays))
+
+    gaps = [g for g in findGaps(since) if gapKey(g) not in triedGaps]
+    gaps = gaps[:maxGaps]
+    logger.info("Found %s gaps to backfill.", len(gaps))
+
+    for num, gap in enumerate(gaps):
+        logger.info("Backfilling %s from %s to %s [%s/%s]",
+                    gap.get('StationName'), gap.get('GapBegin'),
+                    gap.get('GapEnd'), num + 1, len(gaps))
+        if backfill(gap) == 0:  # the API has no data either, remember
+            triedGaps.append(gapKey(gap))
+        diagnostics.emit(gap.get('UniqueId'))
+
+    diagnostics.emit(force=True)
+
+    with open(triedGapsFile, "w") as tg:
+        json.dump(triedGaps, tg)
+
+    if storageLayout == "narrow":
+        inserted, skipped = calibrationStaging.merge()
+        logger.info("Inserted %s new calibrations.", inserted)
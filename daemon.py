@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+"""Run the scraper as a long-running daemon instead of a cron one-shot.
+
+Keeps the API session and the BigQuery client of scraper.py warm, tracks the
+watermark (latest TBTimestamp) of every station in memory and polls every
+station at the cadence it reports at.
+"""
+
+import json
+import time
+import random
+import signal
+import asyncio
+import functools
+import statistics
+
+from collections import deque
+from typing import Optional
+
+import datetime as dt
+
+import scraper  # custom, sets up logging, clients and the station list
+from query import Query  # custom
+from schema import calibrationSchema  # custom
+from staging import StagingTable  # custom
+from sharding import shardStations  # custom
+
+if scraper.storageBackend != "bigquery":
+    raise RuntimeError("daemon.py needs the bigquery storage backend.")
+
+from scraper import (logger, diagnostics, client, store, baseURL, session,
+                     rowify, queryThis, intervalsSince, toLayout, project,
+                     dataset_id, table_id, latestN, timestepDaysMax, flagger,
+                     qualityStateFile, requestTimeout)
+
+# daemon settings -------------------------------------------------------------
+defaultCadence = dt.timedelta(minutes=15)  # until a station's cadence is known
+minCadence = dt.timedelta(minutes=1)
+maxCadence = dt.timedelta(hours=6)
+jitter = 0.1  # +- fraction of the cadence added to every poll
+leaseFactor = 2.5  # lease mode: leases last leaseFactor cadences (at least)
+requestsPerSecond = 2.  # global rate limit for requests to the airmonitor API
+maxConcurrent = 4  # maximum number of stations polled at the same time
+stationRefresh = dt.timedelta(hours=1)  # how often to update the station list
+statusEvery = dt.timedelta(minutes=1)  # how often to write the status file
+statusFile = "airmonitorDaemon.json"  # freshness lag per station
+
+
+class RateLimiter:
+    """A global limit of calls per second shared by all station pollers."""
+    __slots__ = ["_interval", "_next", "_lock"]
+
+    def __init__(self, rate: float):
+        """Create an instance of RateLimiter."""
+        self._interval = 1. / rate
+        self._next = 0.
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        """Wait until the next call is allowed."""
+        async with self._lock:
+            now = time.monotonic()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+            self._next = max(now, self._next) + self._interval
+
+
+class StationState:
+    """In-memory state of a single station."""
+    __slots__ = ["uid", "name", "watermark", "cadence", "recentIds",
+                 "recentQueue", "lastPoll", "held", "loaded"]
+
+    def __init__(self, uid: int, name: str,
+                 watermark: Optional[dt.datetime] = None):
+        """Create an instance of StationState."""
+        self.uid = uid
+        self.name = name
+        self.watermark = watermark  # latest TBTimestamp stored in BigQuery
+        self.cadence = defaultCadence
+        self.recentIds = set()  # latest IdStrings to check overlap against
+        self.recentQueue = deque()  # same as above, to know what to forget
+        self.lastPoll = None
+        self.held = False  # lease mode: held the lease on the previous poll
+        self.loaded = False  # watermark and IdStrings loaded from the store
+
+    def reset(self, watermark: Optional[dt.datetime], idstrings: list) -> None:
+        """Replace watermark and IdStrings (another worker may have polled)."""
+        self.watermark = watermark
+        self.recentIds.clear()
+        self.recentQueue.clear()
+        self.remember(idstrings)
+        self.loaded = True
+
+    def remember(self, idstrings: list) -> None:
+        """Keep the given IdStrings, forgetting all but the latest latestN."""
+        for idstring in idstrings:
+            self.recentIds.add(idstring)
+            self.recentQueue.append(idstring)
+        while len(self.recentQueue) > latestN:
+            self.recentIds.discard(self.recentQueue.popleft())
+
+    def learn(self, rows: list) -> None:
+        """Update watermark and cadence from freshly inserted rows."""
+        tbs = sorted(dt.datetime.fromisoformat(r[0]) for r in rows)
+        self.watermark = max(tbs[-1], self.watermark or tbs[-1])
+
+        steps = [b - a for a, b in zip(tbs[:-1], tbs[1:]) if b > a]
+        if steps:
+            self.cadence = min(max(statistics.median(steps), minCadence),
+                               maxCadence)
+
+    def lag(self, now: dt.datetime) -> Optional[float]:
+        """Return the freshness lag in seconds."""
+        if self.watermark is None:
+            return None
+        return (now - self.watermark).total_seconds()
+
+
+# functions -------------------------------------------------------------------
+def loadWatermarks() -> dict:
+    """Query the latest TBTimestamp of all stations in a single query."""
+    q = Query("UniqueId, MAX(TBTimestamp) AS TBTimestamp",
+              f"`{project}.{dataset_id}.{table_id}`", GROUPBY="UniqueId")
+
+    return {r.get('UniqueId'): r.get('TBTimestamp') for r in queryThis(q)}
+
+
+def loadRecentIds() -> dict:
+    """Query the latest latestN IdStrings of all stations in a single query."""
+    ranked = Query("UniqueId, IdString, ROW_NUMBER() OVER (PARTITION BY "
+                   "UniqueId ORDER BY TBTimestamp DESC) AS rn",
+                   f"`{project}.{dataset_id}.{table_id}`")
+    q = Query(WITHAS=('q', str(ranked)), SELECT="UniqueId, IdString",
+              FROM="q", WHERE=f"rn <= {latestN}")
+
+    recent = dict()
+    for r in queryThis(q):
+        recent.setdefault(r.get('UniqueId'), []).append(r.get('IdString'))
+
+    return recent
+
+
+def writeStatus(states: dict) -> None:
+    """Write the freshness lag and cadence of every station to statusFile."""
+    now = dt.datetime.now(dt.timezone.utc)
+    status = {uid: {"StationName": st.name,
+                    "Watermark": st.watermark and st.watermark.isoformat(),
+                    "LagSeconds": st.lag(now),
+                    "CadenceSeconds": st.cadence.total_seconds(),
+                    "LastPoll": st.lastPoll and st.lastPoll.isoformat()}
+              for uid, st in states.items()}
+
+    with open(statusFile, "w") as sf:
+        json.dump(status, sf, indent=2)
+
+
+class Daemon:
+    """Schedule the polling of all stations until asked to stop."""
+
+    def __init__(self):
+        """Create an instance of Daemon."""
+        self.states = dict()
+        self.tasks = dict()
+        self.stop = asyncio.Event()
+        self.limiter = RateLimiter(requestsPerSecond)
+        self.slots = asyncio.Semaphore(maxConcurrent)
+
+    async def sleep(self, seconds: float) -> None:
+        """Sleep for the given seconds, or less if asked to stop."""
+        try:
+            await asyncio.wait_for(self.stop.wait(), timeout=max(seconds, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    async def poll(self, st: StationState) -> None:
+        """Fetch and insert everything since the watermark of a station."""
+        loop = asyncio.get_running_loop()
+        now = dt.datetime.now(dt.timezone.utc)
+        begin = st.watermark or now - dt.timedelta(days=timestepDaysMax)
+        st.lastPoll = now
+
+        for iv in intervalsSince(begin, now):
+            if self.stop.is_set():  # finish the current batch, skip the rest
+                break
+
+            await self.limiter.wait()
+            rows = await loop.run_in_executor(
+                None, rowify, f"{baseURL}stationdata/{iv}/{st.uid}",
+                [st.uid, st.name], st.recentIds)
+
+            if len(rows) > 0:  # if data is returned
+                logger.info("Inserting %s rows for %s, interval [%s, %s].",
+                            len(rows), st.uid, *iv.split('/'))
+                ids = [r[-1] for r in rows]  # IdString is last in rowify
+                rows = toLayout(flagger.flag(rows))
+                await loop.run_in_executor(None, store.insert, rows)
+                st.learn(rows)
+                st.remember(ids)
+
+        diagnostics.emit(st.uid)  # at most one summary per minInterval
+
+    async def reload(self, st: StationState) -> None:
+        """Load watermark and latest IdStrings of a station from the store."""
+        loop = asyncio.get_running_loop()
+        watermark = await loop.run_in_executor(None, store.latest, st.uid)
+        ids = await loop.run_in_executor(None, store.idStrings, st.uid,
+                                         latestN)
+        st.reset(watermark, ids[::-1])  # oldest first, forgotten first
+
+    def claim(self, st: StationState) -> bool:
+        """Claim (or renew) the lease on a station, always True if no leases.
+
+        The lease lasts at least leaseFactor cadences, so it doesn't run out
+        between two polls of the station.
+        """
+        if scraper.shardMode != "lease":
+            return True
+
+        ttl = max(scraper.leaseSeconds,
+                  leaseFactor * st.cadence.total_seconds() * (1 + jitter))
+        return scraper.leases.claim(st.uid, scraper.workerName, ttl)
+
+    async def station(self, st: StationState) -> None:
+        """Poll a single station at its own cadence."""
+        # spread the first polls over the default cadence
+        await self.sleep(random.uniform(0, defaultCadence.total_seconds()))
+
+        while not self.stop.is_set():
+            if self.claim(st):
+                async with self.slots:
+                    try:
+                        # new stations (added by refresh) start from the
+                        # store, as do stations another worker may have
+                        # polled in the meantime
+                        lease = scraper.shardMode == "lease"
+                        if not st.loaded or (lease and not st.held):
+                            await self.reload(st)
+                        st.held = True
+                        await self.poll(st)
+                        self.claim(st)  # renew with the learned cadence
+                    except asyncio.CancelledError:  # station was removed
+                        raise
+                    except Exception:  # keep the daemon alive
+                        logger.exception("Polling station %s failed.", st.uid)
+            else:
+                st.held = False
+
+            cadence = st.cadence.total_seconds()
+            await self.sleep(cadence * random.uniform(1 - jitter, 1 + jitter))
+
+    async def refresh(self) -> None:
+        """Keep the station list up to date, start and stop the pollers."""
+        loop = asyncio.get_running_loop()
+        stations = scraper.stations  # already requested by scraper.py
+
+        while not self.stop.is_set():
+            if scraper.shardMode == "hash":
+                stations = shardStations(stations, scraper.workerIndex,
+                                         scraper.workerCount)
+
+            for s in stations:
+                uid = s["UniqueId"]
+                if uid not in self.states:
+                    self.states[uid] = StationState(uid, s["StationName"])
+                if uid not in self.tasks:
+                    self.tasks[uid] = asyncio.create_task(
+                        self.station(self.states[uid]))
+
+            # stop polling stations that are gone (or moved to another shard)
+            current = {s["UniqueId"] for s in stations}
+            for uid in [uid for uid in self.tasks if uid not in current]:
+                self.tasks.pop(uid).cancel()
+                del self.states[uid]
+                if scraper.shardMode == "lease":
+                    scraper.leases.release(uid, scraper.workerName)
+                logger.info("Stopped polling station %s.", uid)
+            logger.info("Polling %s stations.", len(self.tasks))
+
+            await self.sleep(stationRefresh.total_seconds())
+            if not self.stop.is_set():
+                try:
+                    response = await loop.run_in_executor(
+                        None, functools.partial(session.get,
+                                                f"{baseURL}stations",
+                                                timeout=requestTimeout))
+                    stations = response.json()
+                except Exception:  # keep the current list, retry later
+                    logger.exception("Updating the station list failed.")
+
+    async def flushCalibrations(self) -> None:
+        """Merge the calibrations staged so far (narrow layout only)."""
+        staged = scraper.calibrationStaging
+        if len(staged) == 0:
+            return
+
+        # keep staging into a fresh table while the old one is merged
+        scraper.calibrationStaging = StagingTable(
+            client, scraper.dataset_ref.table(scraper.calibration_id),
+            schema=calibrationSchema, key="CalibrationId")
+        loop = asyncio.get_running_loop()
+        inserted, skipped = await loop.run_in_executor(None, staged.merge)
+        logger.info("Inserted %s new calibrations.", inserted)
+
+    async def status(self) -> None:
+        """Regularly write and log the freshness lag of all stations."""
+        while not self.stop.is_set():
+            await self.sleep(statusEvery.total_seconds())
+            writeStatus(self.states)
+            await self.flushCalibrations()
+            now = dt.datetime.now(dt.timezone.utc)
+            lags = [st.lag(now) for st in self.states.values()
+                    if st.watermark is not None]
+            if lags:
+                logger.info("Freshness lag: median %ss, max %ss over %s "
+                            "stations.", round(statistics.median(lags)),
+                            round(max(lags)), len(lags))
+
+    async def run(self) -> None:
+        """Run until SIGINT/SIGTERM, then let in-flight batches finish."""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop.set)
+
+        # one query each for all watermarks and all latest IdStrings
+        watermarks = await loop.run_in_executor(None, loadWatermarks)
+        recentIds = await loop.run_in_executor(None, loadRecentIds)
+        logger.info("Loaded watermarks of %s stations.", len(watermarks))
+
+        for s in scraper.stations:
+            uid = s["UniqueId"]
+            self.states[uid] = StationState(uid, s["StationName"])
+            self.states[uid].reset(watermarks.get(uid),
+                                   recentIds.get(uid, []))
+
+        helpers = [asyncio.create_task(self.refresh()),
+                   asyncio.create_task(self.status())]
+        await self.stop.wait()
+
+        logger.info("Shutting down, waiting for in-flight batches.")
+        await asyncio.gather(*helpers, *self.tasks.values())
+        await self.flushCalibrations()
+        diagnostics.emit(force=True)
+        flagger.save(qualityStateFile)
+        writeStatus(self.states)
+
+        if scraper.shardMode == "lease":
+            for uid in self.states:
+                scraper.leases.release(uid, scraper.workerName)
+        logger.info("Daemon stopped.")
+
+
+async def main() -> None:
+    """Create the daemon inside the running event loop and run it."""
+    await Daemon().run()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
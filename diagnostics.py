@@ -0,0 +1,184 @@
+"""Provide aggregated, rate-limited diagnostics of the ingestion."""
+import time
+import logging
+import threading
+
+from collections import Counter
+from typing import Union, Optional
+
+
+class Diagnostics:
+    """Count ingestion events per station and label, log summaries.
+
+    Counting an event is a single counter increment, instead of a log call
+    (and, with the CloudLoggingHandler, an API write) per event. Exemplars are
+    sampled at the 1st, 2nd, 4th, 8th, ... occurrence of an event, keeping the
+    latest maxExemplars. emit() logs one line per station and level, at most
+    every minInterval seconds per station unless forced. Events are logged at
+    level unless levels (a dict of event: level) says otherwise. Thread-safe,
+    e.g. for rowify running in the executor threads of daemon.py.
+    """
+    __slots__ = ["logger", "level", "levels", "maxExemplars", "minInterval",
+                 "counts", "exemplars", "_lastEmit", "_lock"]
+
+    def __init__(self, logger: logging.Logger, level: int = logging.WARNING,
+                 maxExemplars: int = 3, minInterval: float = 60.,
+                 levels: Optional[dict] = None):
+        """Create an instance of Diagnostics."""
+        self.logger = logger
+        self.level = level
+        self.levels = levels or dict()
+        self.maxExemplars = maxExemplars
+        self.minInterval = minInterval
+        self.counts = Counter()  # (uid, event, label) -> count
+        self.exemplars = dict()  # (uid, event, label) -> list of exemplars
+        self._lastEmit = dict()  # uid -> time.monotonic() of last summary
+        self._lock = threading.RLock()
+
+    def count(self, uid: Union[int, str], event: str, label=None,
+              exemplar=None) -> None:
+        """Count an event (with optional label) of station uid."""
+        key = (uid, event, label)
+        with self._lock:
+            n = self.counts[key] + 1
+            self.counts[key] = n
+
+            if n & (n - 1) == 0:  # n is a power of two: keep the exemplar
+                kept = self.exemplars.setdefault(key, [])
+                kept.append(exemplar)
+                if len(kept) > self.maxExemplars:
+                    del kept[0]
+
+    def levelOf(self, event: str) -> int:
+        """Return the level an event is logged at."""
+        return self.levels.get(event, self.level)
+
+    def summary(self, uid: Union[int, str],
+                level: Optional[int] = None) -> list:
+        """Return the summary lines of station uid and reset its counts.
+
+        If level is given, only the events logged at level are summarised.
+        """
+        lines = []
+        with self._lock:
+            keys = sorted((k for k in self.counts if k[0] == uid and
+                           (level is None or self.levelOf(k[1]) == level)),
+                          key=lambda k: (k[1], str(k[2])))
+            popped = [(k, self.counts.pop(k), self.exemplars.pop(k, []))
+                      for k in keys]
+
+        for (_, event, label), n, exemplars in popped:
+            what = event if label is None else f"{event} {label}"
+            examples = [e for e in exemplars if e is not None]
+            line = f"{what} x{n}"
+            if examples:
+                line += f" (e.g. {', '.join(map(str, examples))})"
+            lines.append(line)
+
+        return lines
+
+    def emit(self, uid: Optional[Union[int, str]] = None,
+             force: bool = False) -> int:
+        """Log the summary of station uid (of all stations if None).
+
+        Stations that got a summary less than minInterval seconds ago are
+        skipped (their counts are kept) unless force is set.
+
+        Returns the number of logged summaries.
+        """
+        with self._lock:
+            uids = {k[0] for k in self.counts} if uid is None else {uid}
+            levels = {(k[0], self.levelOf(k[1])) for k in self.counts}
+        now = time.monotonic()
+
+        emitted = 0
+        for u in sorted(uids, key=str):
+            last = self._lastEmit.get(u)
+            recent = last is not None and now - last < self.minInterval
+            if recent and not force:
+                continue
+
+            for level in sorted(lvl for v, lvl in levels if v == u):
+                lines = self.summary(u, level)
+                if lines:
+                    self.logger.log(level, "Ingestion diagnostics for "
+                                    "station %s: %s.", u, "; ".join(lines))
+                    self._lastEmit[u] = now
+                    emitted += 1
+
+        return emitted
+
+
+if __name__ == "__main__":  # benchmark rowify on a noisy payload
+    import datetime as dt
+
+    from api import rowify  # custom
+
+    class RecordCounter(logging.Handler):
+        """Count the records a remote handler would have to send."""
+
+        def __init__(self):
+            super().__init__()
+            self.records = 0
+
+        def emit(self, record: logging.LogRecord) -> None:
+            self.format(record)
+            self.records += 1
+
+    class PerEventDiagnostics(Diagnostics):
+        """Log every single event right away, as rowify used to."""
+        __slots__ = []
+
+        def count(self, uid, event, label=None, exemplar=None) -> None:
+            self.logger.log(self.levelOf(event), "[rowify] %s %s (%s) for "
+                            "station %s.", event, label, exemplar, uid)
+
+    # noisy payload: every point twice, an unknown channel, 11/14 channels
+    labels = ["AIRPRES", "CO", "HUM", "NO", "NO2", "O3", "SO2", "PM1", "PM10",
+              "PM2.5", "PM4"]
+    begin = dt.datetime(2018, 10, 1, tzinfo=dt.timezone.utc)
+    points = []
+    for i in range(5000):
+        tb = begin + dt.timedelta(minutes=15 * (i // 2))
+        te = tb + dt.timedelta(minutes=15)
+        points.append({
+            "TBTimestamp": tb.isoformat(), "TETimestamp": te.isoformat(),
+            "Latitude": "51", "Longitude": "0", "Altitude": "1",
+            "Channels": [{"SensorLabel": label, "PreScaled": 1., "Slope": 1.,
+                          "Offset": 0., "Scaled": 2., "UnitName": "ppb",
+                          "Status": "Valid"} for label in labels]})
+
+    class Session:
+        """Answer every request with the noisy payload."""
+
+        def get(self, url: str, **kwargs):
+            return self
+
+        def json(self) -> list:
+            return list(points)
+
+        def raise_for_status(self) -> None:
+            pass
+
+    logger = logging.getLogger("rowifyBenchmark")
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    handler = RecordCounter()
+    logger.addHandler(handler)
+
+    for name, kind in [("per event", PerEventDiagnostics),
+                       ("aggregated", Diagnostics)]:
+        diagnostics = kind(logger, levels={"channels received/expected":
+                                           logging.DEBUG})
+
+        best = float("inf")
+        for _ in range(5):
+            handler.records = 0
+            t = time.perf_counter()
+            rows = rowify(Session(), diagnostics, "stationdata/begin/end/1",
+                          [1, "Station"])
+            diagnostics.emit(force=True)
+            best = min(best, time.perf_counter() - t)
+
+        print(f"{name}: {len(rows)} rows from {len(points)} points in "
+              f"{best * 1000:.0f} ms, {handler.records} log records.")
@@ -1,13 +1,21 @@
 #!/usr/bin/env python
+import os
+import glob
 import json
 import logging
 
 from typing import Union
 from google.cloud import bigquery
 from google.cloud.bigquery import Dataset, Table
+from google.api_core.exceptions import BadRequest
 
-from schema import airmonitorSchema  # custom
-from query import Query  # custom
+from schema import (airmonitorSchema, airmonitorNarrowSchema,  # custom
+                    calibrationSchema)
+from layout import narrowifyRows, ensureNarrowTables  # custom
+from diagnostics import Diagnostics  # custom
+from staging import StagingTable  # custom
+from storage import BigQueryStorage, LocalStorage  # custom
+from quality import QualityFlagger  # custom
 
 import requests as req
 import datetime as dt  # needed for blocked requests of data
@@ -31,6 +39,10 @@ ch.setFormatter(formatter)
 logger.addHandler(fh)
 logger.addHandler(ch)
 
+# per-point warnings of rowify are counted and logged as one summary/station
+diagnostics = Diagnostics(logger, levels={
+    "channels received/expected": logging.DEBUG})  # expected for most stations
+
 # setting up airmonitor credentials -------------------------------------------
 # needs json file with creds, e.g. {"accountID": "ID", "licenceKey": "KEY"}
 with open('airmonitor_credentials.json', 'r') as ac:
@@ -43,11 +55,26 @@ stations = req.get(baseURL + 'stations').json()
 manualHistoryEnd = dt.datetime.now(dt.timezone.utc)
 timestepDays = 3
 
-# get the client --------------------------------------------------------------
-# make sure right environment variable is set for google account credentials
-client = bigquery.Client()
+# storage settings ------------------------------------------------------------
+# storage backend: "bigquery" or "local" (Parquet files, see storage.py)
+storageBackend = os.environ.get("AIRMONITOR_STORAGE", "bigquery")
+localStorePath = os.environ.get("AIRMONITOR_LOCAL_STORE", "airmonitor_store")
+
+# storage layout: "wide" (schema.airmonitorSchema) or "narrow" (see layout.py)
+storageLayout = "wide"
+tableSchema = (airmonitorSchema if storageLayout == "wide" else
+               airmonitorNarrowSchema)
+
 dataset_id = "airmonitor"
-table_id = "airmonitor"
+table_id = "airmonitor" if storageLayout == "wide" else "airmonitor_narrow"
+calibration_id = "calibration"  # only used by the narrow layout
+view_id = "airmonitor_wide"  # wide view on the narrow layout, for read_ts
+
+# how to avoid inserting duplicates into an existing table:
+#   "merge":  stage the rows of a station and insert only those with unknown
+#             IdStrings server-side (see staging.py), no IdStrings downloaded
+#   "client": download all IdStrings of every station and compare
+dedupMode = "merge" if storageBackend == "bigquery" else "client"
 
 # bool to see if check for duplicates should be done
 checkForDuplicates = False
@@ -58,45 +85,86 @@ genIdStrings = []
 # list to store IdStrings queried from an existing table
 queriedIds = []
 
-
-# create dataset and table reference
-dataset_ref = client.dataset(dataset_id)
-table_ref = dataset_ref.table(table_id)
-
-# try and see if dataset already exists - if not, create it -------------------
-try:
-    dataset = client.get_dataset(dataset_ref)
-    logger.info("Found Dataset %s.", repr(dataset_id))
+# quality settings ------------------------------------------------------------
+# rolling median/MAD state of the QualityFlags, handed over to the scraper
+# (which reads the files of all {worker}s, see scraper.py)
+qualityStatePath = os.environ.get("AIRMONITOR_QUALITY_STATE",
+                                  "airmonitorQuality_{worker}.npz")
+qualityStateFile = qualityStatePath.format(worker="history")
+flagger = QualityFlagger()
+for path in sorted(glob.glob(qualityStatePath.format(worker="*"))):
+    flagger.load(path)
+
+if storageBackend == "bigquery":
+    # get the client ----------------------------------------------------------
+    # make sure right environment variable is set for google account creds
+    client = bigquery.Client()
+    project = client.project
+
+    # create dataset and table reference
+    dataset_ref = client.dataset(dataset_id)
+    table_ref = dataset_ref.table(table_id)
+
+    # try and see if dataset already exists - if not, create it ---------------
     try:
-        table = client.get_table(table_ref)
-        logger.info("Found Table %s.", repr(table_id))
-        checkForDuplicates = True
-
-    except:  # TODO find teh right exception for this
+        dataset = client.get_dataset(dataset_ref)
+        logger.info("Found Dataset %s.", repr(dataset_id))
+        try:
+            table = client.get_table(table_ref)
+            logger.info("Found Table %s.", repr(table_id))
+            checkForDuplicates = True
+
+        except:  # TODO find teh right exception for this
+            logger.info("Creating Table %s.", repr(table_id))
+            table = Table(table_ref, schema=tableSchema)
+            table = client.create_table(table)
+
+    except:  # TODO find the right exception for this
+        # create the dataset
+        logger.info("Creating Dataset %s.", repr(dataset_id))
+        dataset = Dataset(dataset_ref)
+        dataset.location = "EU"
+        dataset = client.create_dataset(dataset)
+        # create a table
         logger.info("Creating Table %s.", repr(table_id))
-        table = Table(table_ref, schema=airmonitorSchema)
+        table = Table(table_ref, schema=tableSchema)
         table = client.create_table(table)
 
-except:  # TODO find the right exception for this
-    # create the dataset
-    logger.info("Creating Dataset %s.", repr(dataset_id))
-    dataset = Dataset(dataset_ref)
-    dataset.location = "EU"
-    dataset = client.create_dataset(dataset)
-    # create a table
-    logger.info("Creating Table %s.", repr(table_id))
-    table = Table(table_ref, schema=airmonitorSchema)
-    table = client.create_table(table)
-
+    # calibration table and wide view for the narrow layout
+    if storageLayout == "narrow":
+        ensureNarrowTables(client, dataset_ref, table_id, calibration_id,
+                           view_id)
 
-# functions -------------------------------------------------------------------
-def queryThis(query: Query) -> list:
-    """Query the given query object and return the resulting list."""
-    q = str(query)  # extra line for clarity. calls the __str__ magic function
+    store = BigQueryStorage(client, table)
 
-    return list(client.query(q).result())
+    # tables created before the QualityFlags get the column, older rows the
+    # INVALID bits (once, retried next run while rows are in streaming buffer)
+    try:
+        flagged = store.ensureQualityFlags(storageLayout == "narrow")
+        if flagged:
+            logger.info("Set the QualityFlags of %d older rows.", flagged)
+    except BadRequest as err:
+        logger.warning("Could not flag the older rows: %s", err)
+
+    # staging tables to collect the rows (and calibrations) of a station in
+    staging = StagingTable(client, table_ref, schema=tableSchema)
+    calibrationStaging = StagingTable(client,
+                                      dataset_ref.table(calibration_id),
+                                      schema=calibrationSchema,
+                                      key="CalibrationId")
+    knownCalibrations = set()  # CalibrationIds already staged in this run
+
+elif storageBackend == "local":
+    store = LocalStorage(localStorePath)
+    logger.info("Using local store %s.", repr(localStorePath))
+    checkForDuplicates = len(store.stations()) > 0
+
+else:
+    raise ValueError(f"Unknown AIRMONITOR_STORAGE {repr(storageBackend)}, "
+                     f"expected 'bigquery' or 'local'.")
 
 
+# functions -------------------------------------------------------------------
 def stringifyID(point: dict, uid: Union[int, str]) -> str:
     """Take a measurement dictionary and return a hopefully unique string id.
 
@@ -156,17 +224,16 @@ def rowify(url: str, additional_info: list = []) -> list:
             channelDict = {ch["SensorLabel"]: ch for ch in channels}
             channelDictKeys = list(channelDict.keys())
 
-            # log a warning if unrecognized channel labels appear
+            # count unrecognized channel labels (summarised per station)
             for cdk in channelDictKeys:
                 if cdk not in tableChannels:
-                    logger.warning("Unrecognized channel label %s for IdString"
-                                   " %s.", cdk, idstring)
+                    diagnostics.count(uid, "unrecognized channel label", cdk,
+                                      idstring)
 
             # kind of diagnostics so see, whether all the data fits in nicely
             if len(tableChannels) != len(channels):
-                logger.debug("Number of expected channels [%s] and received "
-                             "channels [%s] do not match. Received: %s.",
-                             len(tableChannels), len(channels), channelDictKeys)
+                diagnostics.count(uid, "channels received/expected",
+                                  f"{len(channels)}/{len(tableChannels)}")
 
             # create the actual row
             for tch in tableChannels:
@@ -182,7 +249,7 @@ def rowify(url: str, additional_info: list = []) -> list:
             fulldata.append(row)
 
         else:
-            logger.warning("Encountered duplicate IdString %s.", idstring)
+            diagnostics.count(uid, "duplicate IdString", exemplar=idstring)
 
     del rawdata[:]  # freeing memory
     del genIdStrings[:]  # if API not broken this shouldn't do harm+free memory
@@ -198,21 +265,11 @@ for num, s in enumerate(stations):  # iterating over all stations
     logger.info("Working on: %s [%s/%s]", stationName, num+1, len(stations)+1)
 
     # get list of IdStrings for current station if necessary
-    if checkForDuplicates:
+    if checkForDuplicates and dedupMode == "client":
         logger.info("Getting IdStrings for Station %s.", UniqueId)
 
-        # get all TBTimestamps and IdStrings for UniqueId (see above) sorted
-        timestampIdStrings = Query("TBTimestamp, IdString",
-                                   f"`{project}.{dataset_id}.{table_id}`",
-                                   WHERE=f"UniqueId = {UniqueId}",
-                                   ORDERBY="TBTimestamp DESC")
-
-        # use previous query to get all IdStrings (sorted by date)
-        latestIdStrings = Query(WITHAS=('q', str(timestampIdStrings)),
-                                SELECT="IdString", FROM="q")
-
-        # create list of actual IdStrings
-        queriedIds = [r.get('IdString') for r in queryThis(latestIdStrings)]
+        # get all IdStrings for UniqueId (see above) sorted by date
+        queriedIds = store.idStrings(UniqueId)
         logger.info("Queried IdStrings to check for duplicates.")
 
     # get period of measurements
@@ -249,10 +306,31 @@ for num, s in enumerate(stations):  # iterating over all stations
         rows = rowify(f"{baseURL}stationdata/{iv}/{UniqueId}", [UniqueId,
                                                                 stationName])
         if len(rows) > 0:  # if data is returned
-            client.insert_rows(table, rows)
+            rows = flagger.flag(rows)  # append the QualityFlags
+            if storageBackend == "bigquery" and storageLayout == "narrow":
+                rows, calibrations = narrowifyRows(rows, knownCalibrations)
+                calibrationStaging.add(calibrations)
+
+            if checkForDuplicates and dedupMode == "merge":
+                staging.add(rows)
+            else:
+                store.insert(rows)
             del rows[:]  # freeing memory
 
+    # insert all new rows of this station at once
+    if checkForDuplicates and dedupMode == "merge":
+        inserted, skipped = staging.merge()
+        logger.info("Inserted %s rows, skipped %s duplicates.", inserted,
+                    skipped)
+
     del queriedIds[:]  # freeing memory
     del genIdStrings[:]
     print("\n")
+    diagnostics.emit(UniqueId, force=True)
     logger.info("Finished %s.", stationName)
+
+if storageBackend == "bigquery" and storageLayout == "narrow":
+    inserted, skipped = calibrationStaging.merge()
+    logger.info("Inserted %s new calibrations.", inserted)
+
+flagger.save(qualityStateFile)
@@ -0,0 +1,212 @@
+"""Provide the narrow storage layout of the airmonitor data.
+
+Instead of one wide row with 14 channels x 6 fields (mostly None for stations
+with few sensors), the narrow layout stores a repeated Channels record with
+only the measured channels. Slope, Offset and UnitName hardly ever change and
+are moved to a calibration table, referenced by CalibrationId. A view exposes
+the wide columns again, so e.g. tools.read_ts works unchanged on top of it.
+"""
+import hashlib
+
+from typing import Tuple, Optional
+
+from google.api_core.exceptions import NotFound
+from google.cloud.bigquery import Table, SchemaField
+
+from schema import (airmonitorSchema, airmonitorNarrowSchema,  # custom
+                    calibrationSchema, channelColumns)
+
+# fields of a channel in airmonitorSchema and where they are in narrow layout
+channelFields = {"PreScaled": "c.PreScaled", "Slope": "k.Slope",
+                 "Offset": "k.Offset", "Scaled": "c.Scaled",
+                 "UnitName": "k.UnitName", "Status": "c.Status"}
+
+# BigQuery's size of a (non NULL) value of given type in bytes, STRING: 2+len
+typeBytes = {"INTEGER": 8, "FLOAT": 8, "TIMESTAMP": 8, "BOOLEAN": 1}
+
+
+def calibrationId(uid: int, channel: str, slope: Optional[float],
+                  offset: Optional[float], unit: Optional[str]) -> int:
+    """Return a stable id (signed 63 bit int) for a channel's calibration."""
+    key = f"{uid}|{channel}|{slope!r}|{offset!r}|{unit}".encode()
+    return int.from_bytes(hashlib.sha1(key).digest()[:8], "big") >> 1
+
+
+def narrowify(row: tuple) -> Tuple[tuple, list]:
+    """Turn a row tuple in airmonitorSchema into the narrow layout.
+
+    Returns a tuple of the row in airmonitorNarrowSchema and a list of row
+    tuples in calibrationSchema for the channels of the row.
+    """
+    # timestamps/location, UniqueId...QualityFlags after the channels
+    head, tail = row[:5], row[5 + 6*len(channelColumns):]
+    uid = tail[0]
+
+    channels = []
+    calibrations = []
+    for i, channel in enumerate(channelColumns):
+        pre, slope, offset, scaled, unit, status = row[5 + 6*i:11 + 6*i]
+        if (pre, slope, offset, scaled, unit, status) == (None,) * 6:
+            continue  # channel not measured, nothing to store
+
+        cid = calibrationId(uid, channel, slope, offset, unit)
+        channels.append({"Channel": channel, "PreScaled": pre,
+                         "Scaled": scaled, "Status": status,
+                         "CalibrationId": cid})
+        calibrations.append((uid, channel, slope, offset, unit, row[0], cid))
+
+    return ((*head, channels, *tail), calibrations)
+
+
+def narrowifyRows(rows: list, knownCalibrations: set) -> Tuple[list, list]:
+    """Turn row tuples in airmonitorSchema into the narrow layout.
+
+    knownCalibrations is a set of CalibrationIds already taken care of, it is
+    updated with the new ones.
+
+    Returns a tuple of the narrow rows and the new calibration rows.
+    """
+    narrowRows = []
+    newCalibrations = []
+    for row in rows:
+        narrowRow, calibrations = narrowify(row)
+        narrowRows.append(narrowRow)
+        for cal in calibrations:
+            if cal[-1] not in knownCalibrations:  # CalibrationId is last
+                knownCalibrations.add(cal[-1])
+                newCalibrations.append(cal)
+
+    return (narrowRows, newCalibrations)
+
+
+def wideViewQuery(narrow: str, calibration: str) -> str:
+    """Return a query exposing narrow + calibration tables as airmonitorSchema.
+
+    narrow and calibration are the full (quoted) table names.
+    """
+    plain = ["TBTimestamp", "TETimestamp", "Latitude", "Longitude",
+             "Altitude", "UniqueId", "StationName", "IdString",
+             "QualityFlags"]
+
+    columns = []
+    for field in airmonitorSchema:
+        if field.name in plain:
+            columns.append(f"m.{field.name}")
+        else:
+            channel, _, name = field.name.rpartition("_")
+            columns.append(f"MAX(CASE WHEN c.Channel = '{channel}' THEN "
+                           f"{channelFields[name]} END) AS {field.name}")
+
+    return (f"SELECT {', '.join(columns)} "
+            f"FROM {narrow} AS m LEFT JOIN UNNEST(m.Channels) AS c "
+            f"LEFT JOIN {calibration} AS k "
+            f"ON k.CalibrationId = c.CalibrationId "
+            f"GROUP BY {', '.join(f'm.{p}' for p in plain)}")
+
+
+def valueBytes(value, field: SchemaField) -> int:
+    """Return the number of bytes BigQuery bills for a value of field."""
+    if value is None:
+        return 0
+
+    if field.mode == "REPEATED":
+        single = SchemaField(field.name, field.field_type,
+                             fields=field.fields)
+        return sum(valueBytes(v, single) for v in value)
+
+    if field.field_type == "RECORD":
+        return sum(valueBytes(value.get(f.name), f) for f in field.fields)
+
+    if field.field_type == "STRING":
+        return 2 + len(value.encode())
+
+    return typeBytes[field.field_type]
+
+
+def pointBytes(rows: list, schema: list, columns: list = None) -> float:
+    """Return the average number of bytes per row of rows in schema.
+
+    If columns is given, only those (e.g. "UniqueId" or "Channels.Scaled")
+    are counted, i.e. the bytes a query selecting them would scan per row.
+    """
+    def wanted(name: str) -> bool:
+        return columns is None or name in columns
+
+    total = 0
+    for row in rows:
+        for value, field in zip(row, schema):
+            if field.field_type == "RECORD":
+                sub = [f for f in field.fields
+                       if wanted(f"{field.name}.{f.name}")]
+                if sub:
+                    part = SchemaField(field.name, "RECORD", mode=field.mode,
+                                       fields=sub)
+                    total += valueBytes(value, part)
+            elif wanted(field.name):
+                total += valueBytes(value, field)
+
+    return total / max(len(rows), 1)
+
+
+def ensureNarrowTables(client, dataset_ref, table_id: str,
+                       calibration_id: str, view_id: str) -> Table:
+    """Create the narrow table, calibration table and wide view if needed.
+
+    Returns the narrow table.
+    """
+    tables = dict()
+    for tid, schema in [(table_id, airmonitorNarrowSchema),
+                        (calibration_id, calibrationSchema)]:
+        ref = dataset_ref.table(tid)
+        try:
+            tables[tid] = client.get_table(ref)
+        except NotFound:
+            tables[tid] = client.create_table(Table(ref, schema=schema))
+
+    view_ref = dataset_ref.table(view_id)
+    try:
+        client.get_table(view_ref)
+    except NotFound:
+        project = client.project
+        view = Table(view_ref)
+        view.view_query = wideViewQuery(
+            f"`{project}.{dataset_ref.dataset_id}.{table_id}`",
+            f"`{project}.{dataset_ref.dataset_id}.{calibration_id}`")
+        view.view_use_legacy_sql = False
+        client.create_table(view)
+
+    return tables[table_id]
+
+
+if __name__ == "__main__":  # bytes per point of both layouts, see README
+    nPoints = 1000
+    for nChannels in [4, 8, 14]:
+        # synthetic points of a station measuring the first nChannels channels
+        wide = []
+        for i in range(nPoints):
+            tb = f"2018-10-01T{i // 60 % 24:02d}:{i % 60:02d}:00+00:00"
+            row = [tb, tb, "51.5", "-0.1", "12"]
+            for channel in channelColumns:
+                if channelColumns.index(channel) < nChannels:
+                    row += [1.5 * i, 1., 0., 1.5 * i, "ppb", "Valid"]
+                else:
+                    row += [None] * 6
+            idstring = "131150-1538395200-1538396100_" + \
+                       "-".join(["12.345"] * nChannels)
+            wide.append((*row, 131150, "Station Name", idstring, 0))
+
+        narrow, calibrations = narrowifyRows(wide, set())
+        wideScan = ["TBTimestamp", "UniqueId", "CO_Scaled", "CO_Status"]
+        narrowScan = ["TBTimestamp", "UniqueId", "Channels.Channel",
+                      "Channels.Scaled", "Channels.Status"]
+
+        calibrationBytes = (pointBytes(calibrations, calibrationSchema) *
+                            len(calibrations))
+        print(f"{nChannels} channels: stored "
+              f"{pointBytes(wide, airmonitorSchema):.0f} (wide) vs. "
+              f"{pointBytes(narrow, airmonitorNarrowSchema):.0f} (narrow) "
+              f"bytes per point + {calibrationBytes:.0f} bytes of "
+              f"calibrations; read_ts scans "
+              f"{pointBytes(wide, airmonitorSchema, wideScan):.0f} vs. "
+              f"{pointBytes(narrow, airmonitorNarrowSchema, narrowScan):.0f} "
+              f"bytes per point.")
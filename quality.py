@@ -0,0 +1,238 @@
+"""Provide data-quality flags computed during the ingestion.
+
+Every row gets a QualityFlags bitmask: for channel i of schema.channelColumns
+bit i is set if the value is a spike (compared to the rolling median/MAD of
+the station's preceding values of that channel) and bit INVALID + i if the
+value is not usable at all (Status not 'Valid', Scaled < 0 or missing).
+Readers then only need to filter on one column, e.g. with qualityFilter. Rows
+stored before the flags existed get their INVALID bits once, see
+flagExistingQuery (spikes can't be recomputed in SQL).
+"""
+import os
+
+from typing import Union
+
+import datetime as dt
+import numpy as np
+
+from schema import channelColumns  # custom
+
+# bit offsets of the flags
+SPIKE = 0
+INVALID = len(channelColumns)
+
+# positions of Scaled and Status of the channels in a row (airmonitorSchema)
+scaledIdx = [5 + 6*i + 3 for i in range(len(channelColumns))]
+statusIdx = [5 + 6*i + 5 for i in range(len(channelColumns))]
+
+
+def channelMask(channel: str, spike: bool = True,
+                invalid: bool = True) -> int:
+    """Return the bitmask of the flags of a channel (column prefix)."""
+    i = channelColumns.index(channel)
+    return (spike << (SPIKE + i)) | (invalid << (INVALID + i))
+
+
+def qualityFilter(channel: str, spike: bool = True,
+                  invalid: bool = True) -> str:
+    """Return a WHERE condition selecting the rows with a good channel."""
+    mask = channelMask(channel, spike, invalid)
+    return f"(QualityFlags & {mask}) = 0"
+
+
+def flagExistingQuery(table: str, narrow: bool = False) -> str:
+    """Return an UPDATE setting the INVALID bits of rows without QualityFlags.
+
+    Same condition as QualityFlagger (Status 'Valid' and Scaled >= 0, else
+    invalid) computed from the stored columns of table (full, quoted name), in
+    airmonitorSchema or, if narrow, in airmonitorNarrowSchema.
+    """
+    bits = {c: 1 << (INVALID + i) for i, c in enumerate(channelColumns)}
+    if narrow:  # all invalid, minus the valid ones among the stored channels
+        cases = " ".join(f"WHEN '{c}' THEN {b}" for c, b in bits.items())
+        flags = (f"{sum(bits.values())} - (SELECT IFNULL(SUM(CASE c.Channel "
+                 f"{cases} ELSE 0 END), 0) FROM UNNEST(Channels) AS c "
+                 f"WHERE c.Status = 'Valid' AND c.Scaled >= 0)")
+    else:
+        flags = " + ".join(f"CASE WHEN {c}_Status = 'Valid' AND {c}_Scaled "
+                           f">= 0 THEN 0 ELSE {b} END"
+                           for c, b in bits.items())
+
+    return f"UPDATE {table} SET QualityFlags = {flags} " \
+           f"WHERE QualityFlags IS NULL"
+
+
+def invalidFlags(df) -> np.ndarray:
+    """Return the INVALID bits of the rows of a DataFrame in airmonitorSchema.
+
+    Same as flagExistingQuery, for rows stored elsewhere (e.g. LocalStorage).
+    """
+    flags = np.zeros(len(df), dtype=np.int64)
+    for i, channel in enumerate(channelColumns):
+        scaled = np.asarray(df[f"{channel}_Scaled"], dtype=float)
+        with np.errstate(invalid="ignore"):
+            valid = (np.asarray(df[f"{channel}_Status"] == "Valid") &
+                     (scaled >= 0))
+        flags |= np.where(valid, 0, 1 << (INVALID + i))
+
+    return flags
+
+
+def seconds(t: Union[str, dt.datetime]) -> float:
+    """Return a TBTimestamp (ISO string of the API or datetime) as epoch."""
+    if isinstance(t, str):
+        t = dt.datetime.fromisoformat(t)
+    return t.timestamp()
+
+
+def nanMedian(a: np.ndarray, axis: int = 1) -> np.ndarray:
+    """Return the median of a along axis, ignoring NaNs (NaN if all are).
+
+    Much faster than np.nanmedian for many short slices: a single sort, NaNs
+    end up last, and a lookup of the middle element(s) of every slice.
+    """
+    s = np.sort(a, axis=axis)
+    k = (~np.isnan(a)).sum(axis=axis, keepdims=True)
+    lo = np.take_along_axis(s, np.maximum(k - 1, 0) // 2, axis)
+    hi = np.take_along_axis(s, k // 2, axis)
+
+    return np.squeeze((lo + hi) / 2, axis=axis)
+
+
+class QualityFlagger:
+    """Compute QualityFlags for the rows of rowify, station by station.
+
+    Keeps the values of the latest window rows of every station (NaN where
+    not valid), so the rolling statistics carry over from one batch (and run,
+    see save/load) to the next. A value is a spike if it is more than
+    threshold scaled MADs away from the median of the valid values of the
+    preceding window rows (of which at least minPoints have to be valid).
+    The window is only used if the batch starts within maxGap seconds after
+    its last row, otherwise (gaps, rows scraped again or by another worker in
+    between) the station starts over.
+    """
+    __slots__ = ["window", "threshold", "minPoints", "maxGap", "state",
+                 "last"]
+
+    def __init__(self, window: int = 48, threshold: float = 6.,
+                 minPoints: int = 8, maxGap: float = 6*60*60):
+        """Create an instance of QualityFlagger."""
+        self.window = window
+        self.threshold = threshold
+        self.minPoints = minPoints
+        self.maxGap = maxGap
+        self.state = dict()  # UniqueId -> (window x channels) array
+        self.last = dict()  # UniqueId -> epoch of the window's last row
+
+    def flags(self, uid: Union[int, str], rows: list) -> np.ndarray:
+        """Return the QualityFlags of the (time sorted) rows of a station."""
+        n, C, W = len(rows), len(channelColumns), self.window
+
+        scaled = np.array([[row[j] for j in scaledIdx] for row in rows],
+                          dtype=float)  # None -> nan
+        valid = np.array([[row[j] == "Valid" for j in statusIdx]
+                          for row in rows], dtype=bool)
+        with np.errstate(invalid="ignore"):
+            valid &= scaled >= 0
+        values = np.where(valid, scaled, np.nan)
+
+        history = np.full((W, C), np.nan)
+        if uid in self.state and \
+                0 < seconds(rows[0][0]) - self.last[uid] <= self.maxGap:
+            history = self.state[uid]
+        series = np.vstack([history, values])
+        self.state[uid] = series[-W:].copy()
+        self.last[uid] = seconds(rows[-1][0])
+
+        # only the channels the station measures (usually a few of them)
+        measured = ~np.isnan(series).all(axis=0)
+        sub = np.ascontiguousarray(series[:, measured])
+
+        # preceding window values of every row: (n, W, c) view, no copies
+        s0, s1 = sub.strides
+        windows = np.lib.stride_tricks.as_strided(
+            sub, shape=(n, W, sub.shape[1]), strides=(s0, s0, s1))
+
+        median = nanMedian(windows)
+        mad = 1.4826 * nanMedian(np.abs(windows - median[:, None, :]))
+        enough = (~np.isnan(windows)).sum(axis=1) >= self.minPoints
+
+        spike = np.zeros((n, C), dtype=bool)
+        with np.errstate(invalid="ignore"):
+            spike[:, measured] = (enough & (mad > 0) &
+                                  (np.abs(sub[W:] - median) >
+                                   self.threshold * mad))
+
+        bits = np.int64(1) << np.arange(C, dtype=np.int64)
+        return ((spike * (bits << SPIKE)).sum(axis=1) |
+                ((~valid) * (bits << INVALID)).sum(axis=1))
+
+    def flag(self, rows: list) -> list:
+        """Return the rows of rowify with QualityFlags appended."""
+        if len(rows) == 0:
+            return rows
+
+        uidIdx = 5 + 6 * len(channelColumns)  # UniqueId follows the channels
+        stations = dict()
+        for i, row in enumerate(rows):
+            stations.setdefault(row[uidIdx], []).append(i)
+
+        flagged = [None] * len(rows)
+        for uid, idx in stations.items():
+            for i, f in zip(idx, self.flags(uid, [rows[i] for i in idx])):
+                flagged[i] = (*rows[i], int(f))
+
+        return flagged
+
+    def save(self, path: str) -> None:
+        """Save the rolling state to path (.npz)."""
+        np.savez(path, **{str(uid): arr for uid, arr in self.state.items()},
+                 **{f"last{uid}": t for uid, t in self.last.items()})
+
+    def load(self, path: str) -> None:
+        """Load the rolling state saved with save, if path exists.
+
+        Can be called for several files (e.g. of several workers), the
+        latest window of every station is kept.
+        """
+        if not os.path.exists(path):
+            return
+        with np.load(path) as saved:
+            for key in saved.files:
+                if key.startswith("last") or f"last{key}" not in saved.files:
+                    continue  # windows without time can't be joined up
+                uid, last = int(key), float(saved[f"last{key}"])
+                if saved[key].shape == (self.window, len(channelColumns)) \
+                        and last > self.last.get(uid, -np.inf):
+                    self.state[uid], self.last[uid] = saved[key], last
+
+
+if __name__ == "__main__":  # throughput benchmark on synthetic rows
+    import time
+
+    rng = np.random.RandomState(0)
+    nRows, batch = 100000, 288  # batch: 3 days of 15 minute points
+    measured = ["CO", "NO2", "O3", "PM25", "TEMP", "HUM"]
+
+    t0 = dt.datetime(2018, 10, 1, tzinfo=dt.timezone.utc)
+    rows = []
+    for i in range(nRows):
+        row = [t0 + dt.timedelta(minutes=15*i)] + [None] * 4
+        for channel in channelColumns:
+            if channel in measured:
+                v = 10 + rng.normal() + (100 if i % 500 == 0 else 0)
+                row += [v, 1., 0., v, "ppb", "Valid"]
+            else:
+                row += [None] * 6
+        rows.append((*row, i // 10000, "Station", str(i)))
+
+    flagger = QualityFlagger()
+    t = time.perf_counter()
+    flagged = []
+    for i in range(0, nRows, batch):
+        flagged += flagger.flag(rows[i:i + batch])
+    t = time.perf_counter() - t
+
+    spikes = sum(bin(r[-1] & ((1 << INVALID) - 1)).count("1") for r in flagged)
+    print(f"{nRows} rows in {t:.2f} s ({nRows / t:,.0f} rows/s, "
+          f"{t / nRows * 1e6:.1f} us/row), {spikes} spikes flagged.")
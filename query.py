@@ -4,11 +4,12 @@ from typing import Union, Tuple
 
 class Query:
     """A query string."""
-    __slots__ = ["_select", "_from", "_where", "_orderby", "_limit", "_withas"]
+    __slots__ = ["_select", "_from", "_where", "_orderby", "_limit", "_withas",
+                 "_groupby"]
 
     def __init__(self, SELECT: str, FROM: str, WHERE: str = None,
                  ORDERBY: str = None, LIMIT: Union[int, str] = None,
-                 WITHAS: Tuple[str] = None):
+                 WITHAS: Tuple[str] = None, GROUPBY: str = None):
         """Create an instance of Query."""
         # Initialize attributes
         self._select = None
@@ -17,6 +18,7 @@ class Query:
         self._orderby = None
         self._limit = None
         self._withas = None
+        self._groupby = None
 
         # set property managed attributes
         self.SELECT = SELECT
@@ -25,6 +27,7 @@ class Query:
         self.ORDERBY = ORDERBY
         self.LIMIT = LIMIT
         self.WITHAS = WITHAS
+        self.GROUPBY = GROUPBY
 
     def __str__(self) -> str:
         """Create the query string."""
@@ -32,6 +35,7 @@ class Query:
              f"{self.SELECT}"
              f" {self.FROM}"
              f" {self.WHERE}"
+             f" {self.GROUPBY}"
              f" {self.ORDERBY}"
              f" {self.LIMIT}")
 
@@ -102,6 +106,22 @@ class Query:
         else:
             self._where = f"WHERE {WHERE}"
 
+    @property
+    def GROUPBY(self) -> str:
+        """Return the GROUPBY attribute."""
+        return self._groupby
+
+    @GROUPBY.setter
+    def GROUPBY(self, GROUPBY: str) -> None:
+        if GROUPBY is None:
+            self._groupby = ""
+
+        elif not isinstance(GROUPBY, str):
+            raise TypeError(f"Expected str, but {type(GROUPBY)} was given.")
+
+        else:
+            self._groupby = f"GROUP BY {GROUPBY}"
+
     @property
     def ORDERBY(self) -> str:
         """Return the ORDERBY attribute."""
@@ -94,4 +94,47 @@ airmonitorSchema = [
     SchemaField('UniqueId', 'INTEGER', mode='REQUIRED'),
     SchemaField('StationName', 'STRING', mode='REQUIRED'),
     SchemaField('IdString', 'STRING', mode='REQUIRED',
-                description="Str concat of timestamps, sensorlabels and ID.")]
+                description="Str concat of timestamps, sensorlabels and ID."),
+    SchemaField('QualityFlags', 'INTEGER',
+                description="Bitmask of spike/invalid channels, see "
+                            "quality.py.")]
+
+# column prefixes of the channels in airmonitorSchema, in order
+channelColumns = ["AIRPRES", "CO", "HUM", "NO", "NO2", "O3", "SO2", "PM1",
+                  "PM10", "PM25", "PARTICLE_COUNT", "TEMP", "TSP", "VOLTAGE"]
+
+# narrow table schema: one repeated record per channel that was measured
+airmonitorNarrowSchema = [
+    SchemaField('TBTimestamp', 'TIMESTAMP', mode='REQUIRED'),
+    SchemaField('TETimestamp', 'TIMESTAMP', mode='REQUIRED'),
+    SchemaField('Latitude', 'STRING'),
+    SchemaField('Longitude', 'STRING'),
+    SchemaField('Altitude', 'STRING'),
+    SchemaField('Channels', 'RECORD', mode='REPEATED', fields=[
+        SchemaField('Channel', 'STRING', mode='REQUIRED',
+                    description="Column prefix in airmonitorSchema."),
+        SchemaField('PreScaled', 'FLOAT'),
+        SchemaField('Scaled', 'FLOAT'),
+        SchemaField('Status', 'STRING'),
+        SchemaField('CalibrationId', 'INTEGER', mode='REQUIRED',
+                    description="Key into the calibration table.")]),
+    SchemaField('UniqueId', 'INTEGER', mode='REQUIRED'),
+    SchemaField('StationName', 'STRING', mode='REQUIRED'),
+    SchemaField('IdString', 'STRING', mode='REQUIRED',
+                description="Str concat of timestamps, sensorlabels and ID."),
+    SchemaField('QualityFlags', 'INTEGER',
+                description="Bitmask of spike/invalid channels, see "
+                            "quality.py.")]
+
+# slowly changing calibration metadata referenced by airmonitorNarrowSchema
+calibrationSchema = [
+    SchemaField('UniqueId', 'INTEGER', mode='REQUIRED'),
+    SchemaField('Channel', 'STRING', mode='REQUIRED'),
+    SchemaField('Slope', 'FLOAT'),
+    SchemaField('Offset', 'FLOAT'),
+    SchemaField('UnitName', 'STRING'),
+    SchemaField('FirstSeen', 'TIMESTAMP', mode='REQUIRED',
+                description="TBTimestamp of the first point using it."),
+    SchemaField('CalibrationId', 'INTEGER', mode='REQUIRED',
+                description="Hash of UniqueId, Channel, Slope, Offset and "
+                            "UnitName.")]
@@ -1,13 +1,26 @@
 #!/usr/bin/env python
 """A script to scrape the latest data of the airmonitor API."""
 
+import os
+import glob
 import json
+import socket
 import logging
 
-from typing import Union
+from typing import Optional, Collection
 from google.cloud import bigquery
 from google.cloud import logging as glog
+from google.api_core.exceptions import BadRequest
 from query import Query
+from diagnostics import Diagnostics
+from schema import airmonitorSchema, airmonitorNarrowSchema, calibrationSchema
+from layout import narrowifyRows
+from staging import StagingTable
+from storage import BigQueryStorage, LocalStorage
+from quality import QualityFlagger
+from sharding import shardStations, preferenceOrder, LeaseStore, runEnd
+from api import requestTimeout
+import api
 
 import requests as req
 import datetime as dt
@@ -36,6 +49,10 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 logger.addHandler(gcpHandler)  # GCP API call
 
+# per-point warnings of rowify are counted and logged as one summary/station
+diagnostics = Diagnostics(logger, levels={
+    "channels received/expected": logging.DEBUG})  # expected for most stations
+
 
 # setting up airmonitor credentials -------------------------------------------
 # needs json file with creds, e.g. {"accountID": "ID", "licenceKey": "KEY"}
@@ -45,36 +62,118 @@ with open("airmonitor_credentials.json", "r") as ac:
 accountID = credentials["accountID"]
 licenceKey = credentials["licenceKey"]
 baseURL = f"https://api.airmonitors.net/3.5/GET/{accountID}/{licenceKey}/"
-stations = req.get(f"{baseURL}stations").json()
+session = req.Session()  # keeps the connection to the API alive
+stations = session.get(f"{baseURL}stations", timeout=requestTimeout).json()
 
 # time settings
 currentTime = dt.datetime.now(dt.timezone.utc)  # current time as of script run
 timestepDaysMax = 3  # maximum number of days-range to get data batches
 
-# get the client --------------------------------------------------------------
-# make sure right environment variable is set for google account credentials
-client = bigquery.Client()
-project = client.project
+# sharding settings -----------------------------------------------------------
+# to spread the stations over several cron hosts, set AIRMONITOR_SHARD_MODE:
+#   "hash":  only scrape the stations owned by this worker (static subset)
+#   "lease": scrape own stations first, then the ones of other workers, each
+#            one only after claiming a time-limited lease in a shared store
+shardMode = os.environ.get("AIRMONITOR_SHARD_MODE")  # None -> all stations
+workerIndex = int(os.environ.get("AIRMONITOR_WORKER_INDEX", 0))
+workerCount = int(os.environ.get("AIRMONITOR_WORKER_COUNT", 1))
+workerName = f"{socket.gethostname()}-{os.getpid()}"
+leaseStorePath = os.environ.get("AIRMONITOR_LEASE_STORE",
+                                "airmonitor_leases.sqlite")
+leaseSeconds = 15 * 60  # lease duration, renewed after every inserted batch
+# interval of the cron runs, finished stations stay done until the next run
+runSeconds = int(os.environ.get("AIRMONITOR_RUN_SECONDS", 60 * 60))
+
+if shardMode == "hash":
+    stations = shardStations(stations, workerIndex, workerCount)
+    logger.info("Worker %s/%s owns %s stations.", workerIndex + 1,
+                workerCount, len(stations))
+elif shardMode == "lease":
+    stations = preferenceOrder(stations, workerIndex, workerCount)
+    leases = LeaseStore(leaseStorePath)
+    logger.info("Worker %s claims stations from lease store %s.", workerName,
+                repr(leaseStorePath))
+elif shardMode is not None:
+    raise ValueError(f"Unknown AIRMONITOR_SHARD_MODE {repr(shardMode)}, "
+                     f"expected 'hash' or 'lease'.")
+
+# storage settings ------------------------------------------------------------
+# storage backend: "bigquery" or "local" (Parquet files, see storage.py)
+storageBackend = os.environ.get("AIRMONITOR_STORAGE", "bigquery")
+localStorePath = os.environ.get("AIRMONITOR_LOCAL_STORE", "airmonitor_store")
+
+# storage layout: "wide" (schema.airmonitorSchema) or "narrow" (see layout.py)
+storageLayout = "wide"
+
 dataset_id = "airmonitor"
-table_id = "airmonitor"
+table_id = "airmonitor" if storageLayout == "wide" else "airmonitor_narrow"
+calibration_id = "calibration"  # only used by the narrow layout
 
 latestN = 200  # query latest N IdStrings to check for overlap
 
-# create dataset and table reference
-dataset_ref = client.dataset(dataset_id)
-table_ref = dataset_ref.table(table_id)
-
-# directly requesting dataset and table - nothing to catch here
-dataset = client.get_dataset(dataset_ref)
-logger.info("Found Dataset %s.", repr(dataset_id))
-table = client.get_table(table_ref)
-logger.info("Found Table %s.", repr(table_id))
-
-# bool to see if check for duplicates should be done
-checkForDuplicates = True
-
-# list to store newly generated IdStrings to check against for duplicates
-genIdStrings = []
+# how to avoid inserting duplicates:
+#   "merge":  stage the rows of the run and insert only those with unknown
+#             IdStrings server-side (see staging.py), no IdStrings downloaded
+#   "client": download the latest IdStrings of every station and compare
+dedupMode = "merge" if storageBackend == "bigquery" else "client"
+
+# bool to see if check for duplicates should be done (on the client)
+checkForDuplicates = dedupMode == "client"
+
+# quality settings ------------------------------------------------------------
+# rolling median/MAD state of the QualityFlags, carried over between runs: one
+# file per worker ({worker}), the latest window of a station from any of them
+qualityStatePath = os.environ.get("AIRMONITOR_QUALITY_STATE",
+                                  "airmonitorQuality_{worker}.npz")
+qualityStateFile = qualityStatePath.format(worker=workerIndex)
+flagger = QualityFlagger()
+for path in sorted(glob.glob(qualityStatePath.format(worker="*"))):
+    flagger.load(path)
+
+if storageBackend == "bigquery":
+    # get the client ----------------------------------------------------------
+    # make sure right environment variable is set for google account creds
+    client = bigquery.Client()
+    project = client.project
+
+    # create dataset and table reference
+    dataset_ref = client.dataset(dataset_id)
+    table_ref = dataset_ref.table(table_id)
+
+    # directly requesting dataset and table - nothing to catch here
+    dataset = client.get_dataset(dataset_ref)
+    logger.info("Found Dataset %s.", repr(dataset_id))
+    table = client.get_table(table_ref)
+    logger.info("Found Table %s.", repr(table_id))
+
+    store = BigQueryStorage(client, table)
+
+    # tables created before the QualityFlags get the column, older rows the
+    # INVALID bits (once, retried next run while rows are in streaming buffer)
+    try:
+        flagged = store.ensureQualityFlags(storageLayout == "narrow")
+        if flagged:
+            logger.info("Set the QualityFlags of %d older rows.", flagged)
+    except BadRequest as err:
+        logger.warning("Could not flag the older rows: %s", err)
+
+    # staging tables to collect the rows (and calibrations) of this run in
+    staging = StagingTable(client, table_ref, schema=(
+        airmonitorSchema if storageLayout == "wide" else
+        airmonitorNarrowSchema))
+    calibrationStaging = StagingTable(client,
+                                      dataset_ref.table(calibration_id),
+                                      schema=calibrationSchema,
+                                      key="CalibrationId")
+    knownCalibrations = set()  # CalibrationIds already staged in this process
+
+elif storageBackend == "local":
+    store = LocalStorage(localStorePath)
+    logger.info("Using local store %s.", repr(localStorePath))
+
+else:
+    raise ValueError(f"Unknown AIRMONITOR_STORAGE {repr(storageBackend)}, "
+                     f"expected 'bigquery' or 'local'.")
 
 # list to store IdStrings queried from an existing table
 queriedIds = []
@@ -88,159 +187,136 @@ def queryThis(query: Query) -> list:
     return list(client.query(q).result())
 
 
-def stringifyID(point: dict, uid: Union[int, str]) -> str:
-    """Take a measurement dictionary and return a hopefully unique string id.
+def intervalsSince(begin: dt.datetime, end: dt.datetime) -> list:
+    """Create the string intervals for the airmonitor api from begin to end.
 
-    More precisely, it's a concat of the ordinal begin and end timestamps,
-    station uid and the sensor values.
+    The intervals are at most timestepDaysMax days long and start a second
+    after the previous one ended (or after begin).
 
-    Returns the concat of the above mentioned.
+    Returns a list of strings of the form "begin/end".
     """
-    # ordinal time for begin (b) and end (e)
-    b = dt.datetime.fromisoformat(point['TBTimestamp']).strftime('%s')
-    e = dt.datetime.fromisoformat(point['TETimestamp']).strftime('%s')
-    # string concat of all sensor labels
-    values = "-".join([str(sens["Scaled"]) for sens in point["Channels"]])
+    delta = dt.timedelta(days=timestepDaysMax)  # create timedelta as stepsize
+
+    # create list of timesteps
+    timesteps = [begin]
+    while(end - timesteps[-1] > delta):
+        timesteps.append(timesteps[-1] + delta)
+    timesteps.append(end)
+
+    # create string intervals for the airmonitor api
+    intervals = []
+    for i, ts in enumerate(timesteps[:-1]):
+        ts += dt.timedelta(seconds=1)  # small deviation from original val
+        intervals.append(f"{ts.isoformat()}/{timesteps[i+1].isoformat()}")
 
-    idString = f"{uid}-{b}-{e}_{values}"  # actual id string
-    return idString
+    return intervals
 
 
-# function to break down the json data
-def rowify(url: str, additional_info: list = []) -> list:
-    """Request given url and create list of row-tuples containing the data.
+def rowify(url: str, additional_info: list = [],
+           knownIds: Optional[Collection[str]] = None,
+           strict: bool = False) -> list:
+    """Call api.rowify with the session and diagnostics of the scraper.
 
-    The fields of the tuple correspond to the ones in the airmonitorSchema.
-    Filled with None if no measurement data is available.
+    knownIds defaults to queriedIds.
 
     Returns a list of row tuples.
     """
-    # print(f"::: [diag] requsted url: {url}")
-    try:
-        rawdata = req.get(url).json()  # does exactly what you think
-    except json.decoder.JSONDecodeError as err:
-        splits = url.split('/')
-        intvl = f"[{splits[-3]}, {splits[-2]}]"
-        logger.warning("[rowify] No data found for interval %s. "
-                       "Msg: %s.", intvl, err)  # use exc_info=1 for traceback
-        return []  # to be handled later
-
-    fulldata = []
-    for point in rawdata:  # iterating over all measured datapoints
-        uid = additional_info[0]
-        idstring = stringifyID(point, uid)  # create unique IdString
-
-        # check for duplicates
-        if idstring not in genIdStrings and idstring not in queriedIds:
-            genIdStrings.append(idstring)  # if IdString is unique, keep it
-
-            # first part of data
-            row = [point[i] for i in ["TBTimestamp", "TETimestamp", "Latitude",
-                                      "Longitude", "Altitude"]]
-
-            # Channel part of data
-            channels = point["Channels"]
-            tableChannels = ["AIRPRES", "CO", "HUM", "NO", "NO2", "O3", "SO2",
-                             "PM1", "PM10", "PM2.5", "PARTICLE_COUNT", "TEMP",
-                             "TSP", "VOLTAGE"]
-
-            # dict comprehension to get sensorlabel: sensorchannel pairs
-            channelDict = {ch["SensorLabel"]: ch for ch in channels}
-            channelDictKeys = list(channelDict.keys())
-
-            # log a warning if unrecognized channel labels appear
-            for cdk in channelDictKeys:
-                if cdk not in tableChannels:
-                    logger.warning("Unrecognized channel label %s for IdString"
-                                   " %s.", cdk, idstring)
-
-            # kind of diagnostics so see, whether all the data fits in nicely
-            if len(tableChannels) != len(channels):
-                logger.debug("Number of expected channels [%s] and received "
-                             "channels [%s] do not match. Received: %s.",
-                             len(tableChannels), len(channels), channelDictKeys)
-
-            # creating the actual row
-            for tch in tableChannels:
-                if tch in channelDictKeys:
-                    ch = channelDict[tch]
-                    row = [*row, *[ch["PreScaled"], ch["Slope"], ch["Offset"],
-                                   ch["Scaled"], ch["UnitName"], ch["Status"]]]
-                else:
-                    filler = [None] * 6  # no data -> fill with None
-                    row = [*row, *filler]
+    knownIds = queriedIds if knownIds is None else knownIds
 
-            row = tuple([*row, *additional_info, idstring])
-            fulldata.append(row)
+    return api.rowify(session, diagnostics, url, additional_info, knownIds,
+                      strict)
 
-        else:
-            logger.warning("Encountered duplicate IdString %s.", idstring)
 
-    del rawdata[:]  # freeing memory
-    del genIdStrings[:]  # if API not broken this shouldn't do harm+free memory
+def toLayout(rows: list) -> list:
+    """Convert row tuples in airmonitorSchema to the storageLayout.
 
-    return fulldata
+    For the narrow layout, new calibrations are staged in calibrationStaging.
 
+    Returns a list of row tuples to be inserted into table.
+    """
+    if storageLayout == "wide":
+        return rows
 
-# fill data into table --------------------------------------------------------
-for num, s in enumerate(stations):  # iterating over all stations
-    UniqueId = s["UniqueId"]
-    stationName = s["StationName"]
-    logger.info("Updating data for: %s [%s/%s]", stationName, num + 1,
-                len(stations) + 1)
-
-    # get list of IdStrings for current station if necessary
-    if checkForDuplicates:
-        logger.info("Getting IdStrings for Station %s.", UniqueId)
-        timestampIdStrings = Query("TBTimestamp, IdString",
-                                   f"`{project}.{dataset_id}.{table_id}`",
-                                   WHERE=f"UniqueId = {UniqueId}",
-                                   ORDERBY="TBTimestamp DESC",
-                                   LIMIT=latestN)
-        latestIdStrings = Query(WITHAS=('q', str(timestampIdStrings)),
-                                SELECT="IdString", FROM="q")
-        queriedIds = [r.get('IdString') for r in queryThis(latestIdStrings)]
-        logger.info("Queried latest %s IdStrings to check overlap.", latestN)
-
-    # query latest entry in BigQuery
-    [begin] = queryThis(Query("TBTimestamp",
-                              f"`{project}.{dataset_id}.{table_id}`",
-                              f"UniqueId = {UniqueId}", "TBTimestamp DESC",
-                              "1"))
-    begin = begin.get('TBTimestamp')
-
-    logger.info("Latest entry found in database was at TBTimestamp %s.",
-                str(begin))
-    delta = dt.timedelta(days=timestepDaysMax)  # create timedelta as stepsize
-    # end is currentTime
+    rows, calibrations = narrowifyRows(rows, knownCalibrations)
+    calibrationStaging.add(calibrations)
 
-    # create list of timesteps
-    timesteps = [begin]
-    while(currentTime - timesteps[-1] > delta):
-        timesteps.append(timesteps[-1] + delta)
-    timesteps.append(currentTime)
+    return rows
 
-    # create string intervals for the airmonitor api
-    intervals = []
-    for i, ts in enumerate(timesteps[:-1]):
-        ts += dt.timedelta(seconds=1)  # small deviation from original val
-        intervals.append(f"{ts.isoformat()}/{timesteps[i+1].isoformat()}")
 
-    for i, iv in enumerate(intervals):
-        # terminal output updates in percentage
-        print(f"::: Processing data chunks.. [{round(i/len(intervals)*100)}%]",
-              end='')
-        print('\r', end='')
-
-        # actual magic happens in here
-        rows = rowify(f"{baseURL}stationdata/{iv}/{UniqueId}", [UniqueId,
-                                                                stationName])
-        if len(rows) > 0:  # if data is returned
-            logger.info("Inserting rows for interval [%s, %s].", *iv.split('/'))
-            client.insert_rows(table, rows)
-            del rows[:]  # freeing memory
-
-    del queriedIds[:]  # freeing memory
-    del genIdStrings[:]
-    print("\n")
-    logger.info("Finished %s.", stationName)
+# fill data into table --------------------------------------------------------
+if __name__ == "__main__":  # cron one-shot, see daemon.py for the daemon
+    for num, s in enumerate(stations):  # iterating over all stations
+        UniqueId = s["UniqueId"]
+        stationName = s["StationName"]
+
+        # skip stations currently scraped by another worker
+        if shardMode == "lease" and not leases.claim(UniqueId, workerName,
+                                                     leaseSeconds):
+            logger.info("Station %s is leased by another worker, skipping.",
+                        UniqueId)
+            continue
+
+        logger.info("Updating data for: %s [%s/%s]", stationName, num + 1,
+                    len(stations) + 1)
+
+        # get list of IdStrings for current station if necessary
+        if checkForDuplicates:
+            logger.info("Getting IdStrings for Station %s.", UniqueId)
+            queriedIds = store.idStrings(UniqueId, latestN)
+            logger.info("Queried latest %s IdStrings to check overlap.",
+                        latestN)
+
+        # query latest entry in the storage
+        begin = store.latest(UniqueId)
+        if begin is None:  # new station, start with the latest batch
+            begin = currentTime - dt.timedelta(days=timestepDaysMax)
+
+        logger.info("Latest entry found in database was at TBTimestamp %s.",
+                    str(begin))
+        intervals = intervalsSince(begin, currentTime)  # end is currentTime
+
+        for i, iv in enumerate(intervals):
+            # terminal output updates in percentage
+            print(f"::: Processing data chunks.. "
+                  f"[{round(i/len(intervals)*100)}%]", end='')
+            print('\r', end='')
+
+            # actual magic happens in here
+            rows = rowify(f"{baseURL}stationdata/{iv}/{UniqueId}",
+                          [UniqueId, stationName])
+            if len(rows) > 0:  # if data is returned
+                rows = flagger.flag(rows)  # append the QualityFlags
+                if storageBackend == "bigquery":
+                    rows = toLayout(rows)
+                if dedupMode == "merge":
+                    staging.add(rows)
+                else:
+                    logger.info("Inserting rows for interval [%s, %s].",
+                                *iv.split('/'))
+                    store.insert(rows)
+                del rows[:]  # freeing memory
+
+                if shardMode == "lease":  # keep the lease while progressing
+                    leases.claim(UniqueId, workerName, leaseSeconds)
+
+        # insert the new rows of this station before handing it back
+        if dedupMode == "merge":
+            logger.info("Merging %s staged rows.", len(staging))
+            inserted, skipped = staging.merge()
+            logger.info("Inserted %s rows, skipped %s duplicates.", inserted,
+                        skipped)
+
+        if storageBackend == "bigquery" and storageLayout == "narrow":
+            inserted, skipped = calibrationStaging.merge()
+            logger.info("Inserted %s new calibrations.", inserted)
+
+        del queriedIds[:]  # freeing memory
+        print("\n")
+        diagnostics.emit(UniqueId, force=True)
+        logger.info("Finished %s.", stationName)
+
+        if shardMode == "lease":  # nobody scrapes it again in this run
+            leases.finish(UniqueId, workerName,
+                          runEnd(runSeconds, currentTime.timestamp()))
+
+    flagger.save(qualityStateFile)
@@ -0,0 +1,196 @@
+"""Provide helpers to split the station list across several scraper hosts."""
+import hashlib
+import sqlite3
+import time
+
+from typing import Union, Optional
+
+
+def stationWeight(uid: Union[int, str], worker: Union[int, str]) -> int:
+    """Return the (deterministic) rendezvous hash weight of uid for worker."""
+    digest = hashlib.sha1(f"{worker}:{uid}".encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def ownerOf(uid: Union[int, str], workerCount: int) -> int:
+    """Return the index of the worker owning the station with given uid.
+
+    Uses rendezvous (highest random weight) hashing, so changing the number of
+    workers only moves the stations of the added/removed worker.
+    """
+    if workerCount < 1:
+        raise ValueError(f"Expected workerCount >= 1, but {workerCount} was "
+                         f"given.")
+
+    return max(range(workerCount), key=lambda w: stationWeight(uid, w))
+
+
+def shardStations(stations: list, workerIndex: int, workerCount: int) -> list:
+    """Return the subset of stations owned by worker workerIndex."""
+    if not 0 <= workerIndex < workerCount:
+        raise ValueError(f"Expected 0 <= workerIndex < {workerCount}, but "
+                         f"workerIndex={workerIndex}.")
+
+    return [s for s in stations
+            if ownerOf(s["UniqueId"], workerCount) == workerIndex]
+
+
+def preferenceOrder(stations: list, workerIndex: int,
+                    workerCount: int) -> list:
+    """Return all stations, the ones owned by workerIndex first.
+
+    The remaining stations follow in the order of their owners, starting with
+    the next worker index, so idle workers pick up the work of dead ones
+    without all of them piling onto the same shard.
+    """
+    def rank(s: dict) -> int:
+        owner = ownerOf(s["UniqueId"], workerCount)
+        return (owner - workerIndex) % workerCount
+
+    return sorted(stations, key=rank)
+
+
+class LeaseStore:
+    """A SQLite backed table of time-limited station leases.
+
+    Every worker claims a station before scraping it; a claim only succeeds if
+    the station is not leased at all, the lease of another worker has expired
+    or the worker already holds the lease (which renews it). Stations of dead
+    workers are thus rebalanced as soon as their leases run out. A finished
+    station can't be claimed by anyone until its DoneUntil (e.g. the start of
+    the next cron run) has passed.
+
+    The leases rely on SQLite's file locking, so all workers have to run on
+    one host (or it is for testing): locking on network filesystems (NFS,
+    SMB) is often broken and two workers could then hold the same lease.
+    """
+    __slots__ = ["_path", "_conn"]
+
+    def __init__(self, path: str, timeout: float = 30.):
+        """Create an instance of LeaseStore, creating the table if needed."""
+        self._path = path
+        # autocommit mode, every statement below is atomic on its own
+        self._conn = sqlite3.connect(path, timeout=timeout,
+                                     isolation_level=None)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS leases ("
+                           "UniqueId INTEGER PRIMARY KEY, "
+                           "Worker TEXT NOT NULL, "
+                           "Expires REAL NOT NULL, "
+                           "DoneUntil REAL NOT NULL DEFAULT 0)")
+        try:  # lease files created before DoneUntil existed
+            self._conn.execute("ALTER TABLE leases ADD COLUMN "
+                               "DoneUntil REAL NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError:  # duplicate column, already there
+            pass
+
+    def __repr__(self) -> str:
+        return f"LeaseStore({self._path!r})"
+
+    def claim(self, uid: Union[int, str], worker: str, ttl: float,
+              now: Optional[float] = None) -> bool:
+        """Claim (or renew) the lease on uid for ttl seconds.
+
+        Returns True if worker holds the lease afterwards.
+        """
+        now = time.time() if now is None else now
+        cur = self._conn.execute(
+            "INSERT INTO leases (UniqueId, Worker, Expires) VALUES (?, ?, ?) "
+            "ON CONFLICT(UniqueId) DO UPDATE SET "
+            "Worker = excluded.Worker, Expires = excluded.Expires "
+            "WHERE (leases.Expires < ? OR leases.Worker = excluded.Worker) "
+            "AND leases.DoneUntil <= ?",
+            (int(uid), worker, now + ttl, now, now))
+
+        return cur.rowcount == 1
+
+    def finish(self, uid: Union[int, str], worker: str,
+               until: float) -> None:
+        """Mark uid as done (if leased by worker) until the time until.
+
+        Unlike release, nobody can claim the station again before until, so
+        workers going through all stations don't scrape it a second time.
+        """
+        self._conn.execute("UPDATE leases SET DoneUntil = ? WHERE "
+                           "UniqueId = ? AND Worker = ?",
+                           (until, int(uid), worker))
+
+    def release(self, uid: Union[int, str], worker: str) -> None:
+        """Release the lease on uid if it is held by worker."""
+        self._conn.execute("DELETE FROM leases WHERE UniqueId = ? AND "
+                           "Worker = ?", (int(uid), worker))
+
+    def holders(self, now: Optional[float] = None) -> dict:
+        """Return a dict of UniqueId: worker for all active leases."""
+        now = time.time() if now is None else now
+        cur = self._conn.execute("SELECT UniqueId, Worker FROM leases "
+                                 "WHERE Expires >= ?", (now,))
+
+        return dict(cur.fetchall())
+
+    def close(self) -> None:
+        """Close the connection to the lease store."""
+        self._conn.close()
+
+
+def runEnd(runSeconds: float, now: Optional[float] = None) -> float:
+    """Return the end of the current run, runs start every runSeconds."""
+    now = time.time() if now is None else now
+    return (now // runSeconds + 1) * runSeconds
+
+
+def _simulateWorker(path: str, workerIndex: int, workerCount: int,
+                    stations: list, scraped) -> None:
+    """Go through all stations like scraper.py in lease mode (see below)."""
+    leases = LeaseStore(path)
+    worker = f"worker{workerIndex}"
+    for s in preferenceOrder(stations, workerIndex, workerCount):
+        if leases.claim(s["UniqueId"], worker, 60):
+            scraped.put((s["UniqueId"], worker))
+            time.sleep(0.01)  # scraping
+            leases.finish(s["UniqueId"], worker, runEnd(3600))
+    leases.close()
+
+
+def _dieHolding(path: str, uid: int, ttl: float) -> None:
+    """Claim uid and exit without finishing or releasing it (a dead worker)."""
+    LeaseStore(path).claim(uid, "dead", ttl)
+
+
+if __name__ == "__main__":  # concurrent workers on one lease file
+    import os
+    import tempfile
+    import multiprocessing as mp
+
+    nWorkers, nStations = 4, 20
+    stations = [{"UniqueId": uid} for uid in range(nStations)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "leases.sqlite")
+        LeaseStore(path).close()  # create the table before the race
+        scraped = mp.Queue()
+        workers = [mp.Process(target=_simulateWorker,
+                              args=(path, i, nWorkers, stations, scraped))
+                   for i in range(nWorkers)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        claims = []
+        while not scraped.empty():
+            claims.append(scraped.get())
+        uids = sorted(uid for uid, _ in claims)
+        assert uids == list(range(nStations)), f"Scraped {uids}."
+        print(f"{nWorkers} workers scraped {nStations} stations exactly once "
+              f"({len({w for _, w in claims})} workers did some).")
+
+        # the lease of a dead worker blocks the station only until ttl ends
+        uid, ttl = nStations, 2.
+        dead = mp.Process(target=_dieHolding, args=(path, uid, ttl))
+        dead.start()
+        dead.join()
+        leases = LeaseStore(path)
+        assert not leases.claim(uid, "worker0", 60), "Claimed a held lease."
+        time.sleep(ttl + 0.1)
+        assert leases.claim(uid, "worker0", 60), "Lease of dead worker kept."
+        leases.close()
+        print(f"A dead worker's station was claimed again after {ttl} s.")
@@ -0,0 +1,137 @@
+"""Provide server-side deduplication of new rows via a staging table."""
+import json
+import uuid
+import tempfile
+
+from typing import Tuple
+
+import datetime as dt
+
+from google.cloud import bigquery
+from google.cloud.bigquery import Table
+
+from schema import airmonitorSchema  # custom
+
+
+def insertNewQuery(target: str, staging: str, columns: list,
+                   key: str = "IdString") -> str:
+    """Return a query inserting all rows of staging not yet in target.
+
+    Rows are matched on key, so none of the stored keys have to be downloaded.
+    Plain INSERT ... WHERE NOT EXISTS, which BigQuery (and most other SQL
+    engines) understand.
+    """
+    cols = ", ".join(columns)
+
+    return (f"INSERT INTO {target} ({cols}) "
+            f"SELECT {cols} FROM {staging} AS S "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {target} AS T "
+            f"WHERE T.{key} = S.{key})")
+
+
+class StagingTable:
+    """Collect the rows of a run and merge them into the target table.
+
+    Rows are buffered in a local temporary file as newline delimited JSON, so
+    a whole station history doesn't need to fit in memory. merge() loads them
+    into a per-run staging table (one load job) and inserts the new ones into
+    the target table (one query), dropping the staging table afterwards.
+    """
+    __slots__ = ["_client", "_target", "_ref", "_buffer", "_ids", "_schema",
+                 "_expiration", "_key"]
+
+    def __init__(self, client: bigquery.Client, table_ref,
+                 schema: list = airmonitorSchema, expiration: int = 24,
+                 key: str = "IdString"):
+        """Create an instance of StagingTable next to the table table_ref.
+
+        Rows are matched on the field key. The staging table expires after
+        expiration hours in case the run does not get to merge().
+        """
+        self._client = client
+        self._schema = schema
+        self._key = key
+        self._target = table_ref
+        self._buffer = tempfile.TemporaryFile()
+        self._ids = set()  # keys of this run, no need to stage twice
+
+        staging_id = f"{table_ref.table_id}_staging_{uuid.uuid4().hex[:12]}"
+        self._ref = client.dataset(table_ref.dataset_id).table(staging_id)
+        self._expiration = expiration
+
+    def __len__(self) -> int:
+        """Return the number of staged rows."""
+        return len(self._ids)
+
+    def add(self, rows: list) -> None:
+        """Stage the given row tuples (in the order of the schema)."""
+        names = [field.name for field in self._schema]
+        k = names.index(self._key)
+        for row in rows:
+            if row[k] in self._ids:
+                continue
+            self._ids.add(row[k])
+            line = json.dumps(dict(zip(names, row))) + "\n"
+            self._buffer.write(line.encode())
+
+    def merge(self) -> Tuple[int, int]:
+        """Load the staged rows and insert the new ones into the target.
+
+        Returns a tuple of the number of inserted and skipped rows.
+        """
+        staged = len(self)
+        if staged == 0:
+            return (0, 0)
+
+        staging = Table(self._ref, schema=self._schema)
+        staging.expires = (dt.datetime.now(dt.timezone.utc) +
+                           dt.timedelta(hours=self._expiration))
+        staging = self._client.create_table(staging)
+
+        try:
+            config = bigquery.LoadJobConfig()
+            config.source_format = \
+                bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+            config.schema = self._schema
+            self._buffer.seek(0)
+            self._client.load_table_from_file(self._buffer, self._ref,
+                                              job_config=config).result()
+
+            project = self._client.project
+            q = insertNewQuery(
+                f"`{project}.{self._target.dataset_id}."
+                f"{self._target.table_id}`",
+                f"`{project}.{self._ref.dataset_id}.{self._ref.table_id}`",
+                [field.name for field in self._schema], self._key)
+            job = self._client.query(q)
+            job.result()
+            inserted = job.num_dml_affected_rows or 0
+
+        finally:
+            self._client.delete_table(self._ref)
+
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._ids.clear()
+
+        return (inserted, staged - inserted)
+
+
+if __name__ == "__main__":  # check insertNewQuery on an in-process engine
+    import sqlite3
+
+    conn = sqlite3.connect(":memory:")
+    for name in ["target", "staging"]:
+        conn.execute(f"CREATE TABLE {name} (IdString TEXT, Value REAL)")
+    conn.executemany("INSERT INTO target VALUES (?, ?)",
+                     [("a", 1.), ("b", 2.)])
+    conn.executemany("INSERT INTO staging VALUES (?, ?)",
+                     [("b", 2.), ("c", 3.), ("d", 4.)])
+
+    q = insertNewQuery("target", "staging", ["IdString", "Value"])
+    assert conn.execute(q).rowcount == 2, "Expected 2 inserted rows."
+    assert conn.execute(q).rowcount == 0, "Expected nothing on a rerun."
+    ids = [r[0] for r in conn.execute("SELECT IdString FROM target "
+                                      "ORDER BY IdString")]
+    assert ids == ["a", "b", "c", "d"], f"Got {ids}."
+    print(f"insertNewQuery OK on SQLite {sqlite3.sqlite_version}.")
@@ -0,0 +1,339 @@
+"""Provide storage backends to write the airmonitor data to and read from.
+
+BigQueryStorage stores into the BigQuery table, LocalStorage into Parquet
+files on disk, partitioned by station and day, so the pipeline and the
+notebooks also work offline. Both take and return rows in airmonitorSchema.
+"""
+import os
+import uuid
+
+from abc import ABC, abstractmethod
+from typing import Optional, Union
+
+import datetime as dt
+import pandas as pd
+
+from query import Query  # custom
+from quality import channelMask, flagExistingQuery, invalidFlags  # custom
+from schema import airmonitorSchema  # custom
+
+try:  # only needed for LocalStorage
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# column names of airmonitorSchema, in order
+columnNames = [field.name for field in airmonitorSchema]
+
+
+class Storage(ABC):
+    """Interface of a storage backend for rows in airmonitorSchema."""
+
+    @abstractmethod
+    def insert(self, rows: list) -> None:
+        """Store the given row tuples."""
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        """Make sure all inserted rows are stored."""
+        pass
+
+    @abstractmethod
+    def stations(self) -> list:
+        """Return the UniqueIds of all stations with stored data."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def latest(self, uid: Union[int, str]) -> Optional[dt.datetime]:
+        """Return the latest TBTimestamp of a station (None if no data)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def idStrings(self, uid: Union[int, str], limit: int = None) -> list:
+        """Return the (latest limit) IdStrings of a station."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def scan(self, uid: Union[int, str], begin: Optional[dt.datetime] = None,
+             end: Optional[dt.datetime] = None,
+             columns: list = None) -> pd.DataFrame:
+        """Return the rows of a station with begin < TBTimestamp <= end."""
+        raise NotImplementedError
+
+    def read(self, sl: str, uid: Union[int, str], begin: dt.datetime,
+             end: dt.datetime, dropSpikes: bool = False) -> pd.DataFrame:
+        """Return the valid values of a channel as columns ts and {sl}_ts.
+
+        Same as the prebuilt query of tools.read_ts, sl is the column prefix.
+        With dropSpikes only the QualityFlags are checked, rows without them
+        (not flagged yet, see BigQueryStorage.ensureQualityFlags) are dropped.
+        """
+        df = self.scan(uid, begin - dt.timedelta(microseconds=1), end,
+                       columns=["TBTimestamp", f"{sl}_Scaled",
+                                "QualityFlags" if dropSpikes else
+                                f"{sl}_Status"])
+        if dropSpikes:
+            flags = df.QualityFlags.fillna(channelMask(sl)).astype("int64")
+            valid = (flags & channelMask(sl)) == 0
+        else:
+            valid = ((df[f"{sl}_Status"] == "Valid") &
+                     (df[f"{sl}_Scaled"] >= 0))
+        df = df[valid]
+
+        return (df.rename(columns={"TBTimestamp": "ts",
+                                   f"{sl}_Scaled": f"{sl}_ts"})
+                  .sort_values("ts")[["ts", f"{sl}_ts"]]
+                  .reset_index(drop=True))
+
+
+def utc(t: dt.datetime) -> pd.Timestamp:
+    """Return t as UTC pandas Timestamp, naive datetimes are taken as UTC."""
+    t = pd.Timestamp(t)
+    return t.tz_localize("UTC") if t.tzinfo is None else t.tz_convert("UTC")
+
+
+def toRows(df: pd.DataFrame) -> list:
+    """Turn a DataFrame (e.g. of Storage.scan) into row tuples, NaN -> None."""
+    df = df[columnNames].astype(object)
+
+    return list(df.where(df.notna(), None).itertuples(index=False, name=None))
+
+
+class BigQueryStorage(Storage):
+    """Store rows in a BigQuery table via streaming inserts.
+
+    read_table is the full name of the table (or view) with airmonitorSchema
+    to scan from, e.g. airmonitor_wide for the narrow layout (see layout.py).
+    Rows given to insert have to be in the layout of the table.
+    """
+
+    def __init__(self, client, table, read_table: str = None,
+                 batchSize: int = 500):
+        """Create an instance of BigQueryStorage."""
+        self.client = client
+        self.batchSize = batchSize  # rows per streaming insert request
+        self.table = table
+        self.name = f"{table.project}.{table.dataset_id}.{table.table_id}"
+        self.read_table = read_table or self.name
+
+    def _query(self, query: Query) -> list:
+        return list(self.client.query(str(query)).result())
+
+    def ensureQualityFlags(self, narrow: bool = False) -> int:
+        """Add the column QualityFlags if missing and flag the older rows.
+
+        Rows stored before the column existed get their INVALID bits with one
+        UPDATE (see quality.flagExistingQuery, narrow for the narrow layout),
+        so readers can filter on QualityFlags alone. Returns the number of
+        updated rows. Rows still in the streaming buffer can't be updated,
+        BigQuery then raises BadRequest and the next call tries again.
+        """
+        if "QualityFlags" not in [field.name for field in self.table.schema]:
+            self.table.schema = [*self.table.schema, airmonitorSchema[-1]]
+            self.table = self.client.update_table(self.table, ["schema"])
+
+        # only the (cheap) QualityFlags column is scanned if all are flagged
+        q = Query("COUNT(*) AS n", f"`{self.name}`",
+                  WHERE="QualityFlags IS NULL")
+        [unflagged] = self._query(q)
+        if unflagged.get('n') == 0:
+            return 0
+
+        job = self.client.query(flagExistingQuery(f"`{self.name}`", narrow))
+        job.result()
+        return job.num_dml_affected_rows or 0
+
+    def insert(self, rows: list) -> None:
+        """Stream the rows in batches, raise if any of them were rejected.
+
+        All batches are tried, the RuntimeError lists the first errors.
+        """
+        errors = []
+        for i in range(0, len(rows), self.batchSize):
+            batch = self.client.insert_rows(self.table,
+                                            rows[i:i + self.batchSize])
+            errors += [{**e, "index": e.get("index", 0) + i} for e in batch]
+        if errors:
+            raise RuntimeError(f"{len(errors)} of {len(rows)} rows were not "
+                               f"inserted into {self.name}, e.g. "
+                               f"{errors[:3]}.")
+
+    def stations(self) -> list:
+        q = Query("DISTINCT UniqueId", f"`{self.name}`")
+        return [r.get('UniqueId') for r in self._query(q)]
+
+    def latest(self, uid: Union[int, str]) -> Optional[dt.datetime]:
+        q = Query("MAX(TBTimestamp) AS TBTimestamp", f"`{self.name}`",
+                  WHERE=f"UniqueId = {uid}")
+        [latest] = self._query(q)
+        return latest.get('TBTimestamp')
+
+    def idStrings(self, uid: Union[int, str], limit: int = None) -> list:
+        q = Query("IdString", f"`{self.name}`", WHERE=f"UniqueId = {uid}",
+                  ORDERBY="TBTimestamp DESC", LIMIT=limit)
+        return [r.get('IdString') for r in self._query(q)]
+
+    def scan(self, uid: Union[int, str], begin: Optional[dt.datetime] = None,
+             end: Optional[dt.datetime] = None,
+             columns: list = None) -> pd.DataFrame:
+        where = f"UniqueId = {uid}"
+        if begin is not None:
+            where += f" AND TBTimestamp > '{begin}'"
+        if end is not None:
+            where += f" AND TBTimestamp <= '{end}'"
+        q = Query(", ".join(columns or columnNames), f"`{self.read_table}`",
+                  WHERE=where, ORDERBY="TBTimestamp")
+        return self.client.query(str(q)).to_dataframe()
+
+
+class LocalStorage(Storage):
+    """Store rows in Parquet files, partitioned by station and day.
+
+    The files live in root/UniqueId=<id>/Date=<YYYY-MM-DD>/, every insert
+    adds a file per partition it touches. Partitions with more than maxFiles
+    files are compacted into a single one (dropping duplicate IdStrings).
+    Reads only open the partitions in range and memory-map the files.
+    """
+
+    def __init__(self, root: str, maxFiles: int = 16):
+        """Create an instance of LocalStorage."""
+        if pa is None:
+            raise RuntimeError("LocalStorage needs the package pyarrow.")
+
+        self.root = root
+        self.maxFiles = maxFiles
+
+        types = {"TIMESTAMP": pa.timestamp("us", tz="UTC"),
+                 "FLOAT": pa.float64(), "INTEGER": pa.int64(),
+                 "STRING": pa.string()}
+        self.schema = pa.schema([pa.field(f.name, types[f.field_type])
+                                 for f in airmonitorSchema])
+        os.makedirs(root, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"LocalStorage({self.root!r})"
+
+    def _stationDir(self, uid: Union[int, str]) -> str:
+        return os.path.join(self.root, f"UniqueId={int(uid)}")
+
+    def _days(self, uid: Union[int, str]) -> list:
+        """Return the sorted days (YYYY-MM-DD) with data of a station."""
+        path = self._stationDir(uid)
+        if not os.path.isdir(path):
+            return []
+        return sorted(d.split("=", 1)[1] for d in os.listdir(path)
+                      if d.startswith("Date="))
+
+    def _files(self, uid: Union[int, str], day: str) -> list:
+        path = os.path.join(self._stationDir(uid), f"Date={day}")
+        return sorted(os.path.join(path, f) for f in os.listdir(path)
+                      if f.endswith(".parquet"))
+
+    def _readDay(self, uid: Union[int, str], day: str,
+                 columns: list = None) -> pd.DataFrame:
+        tables = [pq.read_table(f, columns=columns, memory_map=True)
+                  for f in self._files(uid, day)]
+        return pa.concat_tables(tables).to_pandas()
+
+    def _compact(self, uid: Union[int, str], day: str) -> None:
+        files = self._files(uid, day)
+        df = self._readDay(uid, day).drop_duplicates("IdString")
+        self._write(df, uid, day)
+        for f in files:
+            os.remove(f)
+
+    def _write(self, df: pd.DataFrame, uid: Union[int, str], day: str) -> None:
+        path = os.path.join(self._stationDir(uid), f"Date={day}")
+        os.makedirs(path, exist_ok=True)
+        table = pa.Table.from_pandas(df.sort_values("TBTimestamp"),
+                                     schema=self.schema, preserve_index=False)
+        # write to a temporary name first, so readers never see half a file
+        tmp = os.path.join(path, f".{uuid.uuid4().hex}.tmp")
+        pq.write_table(table, tmp)
+        os.replace(tmp, os.path.join(path, f"{uuid.uuid4().hex}.parquet"))
+
+    def insert(self, rows: list) -> None:
+        if len(rows) == 0:
+            return
+
+        df = pd.DataFrame(rows, columns=columnNames)
+        for ts in ["TBTimestamp", "TETimestamp"]:
+            df[ts] = pd.to_datetime(df[ts], utc=True)
+        # rows without QualityFlags (e.g. synced unflagged): INVALID bits only
+        unflagged = df.QualityFlags.isna()
+        if unflagged.any():
+            df.loc[unflagged, "QualityFlags"] = invalidFlags(df[unflagged])
+        days = df.TBTimestamp.dt.strftime("%Y-%m-%d")
+
+        for (uid, day), part in df.groupby([df.UniqueId, days]):
+            self._write(part, uid, day)
+            if len(self._files(uid, day)) > self.maxFiles:
+                self._compact(uid, day)
+
+    def stations(self) -> list:
+        return sorted(int(d.split("=", 1)[1]) for d in os.listdir(self.root)
+                      if d.startswith("UniqueId="))
+
+    def latest(self, uid: Union[int, str]) -> Optional[dt.datetime]:
+        days = self._days(uid)
+        if not days:
+            return None
+        # only the latest partition needs to be read
+        df = self._readDay(uid, days[-1], columns=["TBTimestamp"])
+        return df.TBTimestamp.max().to_pydatetime()
+
+    def idStrings(self, uid: Union[int, str], limit: int = None) -> list:
+        ids = dict()  # ordered, without the duplicates of repeated inserts
+        for day in reversed(self._days(uid)):  # latest partitions first
+            df = self._readDay(uid, day, columns=["TBTimestamp", "IdString"])
+            ids.update(dict.fromkeys(df.sort_values("TBTimestamp",
+                                                    ascending=False)
+                                     .IdString))
+            if limit is not None and len(ids) >= limit:
+                break
+        return list(ids)[:limit]
+
+    def scan(self, uid: Union[int, str], begin: Optional[dt.datetime] = None,
+             end: Optional[dt.datetime] = None,
+             columns: list = None) -> pd.DataFrame:
+        cols = list(columns or columnNames)
+        readCols = ["TBTimestamp", "IdString",
+                    *[c for c in cols if c not in ["TBTimestamp", "IdString"]]]
+
+        begin = None if begin is None else utc(begin)
+        end = None if end is None else utc(end)
+
+        # partition pruning on the day, before opening any file
+        days = [d for d in self._days(uid)
+                if (begin is None or d >= f"{begin:%Y-%m-%d}") and
+                   (end is None or d <= f"{end:%Y-%m-%d}")]
+        if not days:
+            return pd.DataFrame(columns=cols)
+
+        df = pd.concat([self._readDay(uid, d, readCols) for d in days],
+                       ignore_index=True)
+        if begin is not None:
+            df = df[df.TBTimestamp > begin]
+        if end is not None:
+            df = df[df.TBTimestamp <= end]
+        df = df.drop_duplicates("IdString")  # not yet compacted partitions
+
+        return df.sort_values("TBTimestamp")[cols].reset_index(drop=True)
+
+
+def sync(source: Storage, target: Storage, stations: list = None,
+         since: Optional[dt.datetime] = None) -> int:
+    """Copy all rows of source newer than the latest ones of target.
+
+    Returns the number of copied rows.
+    """
+    copied = 0
+    for uid in stations or source.stations():
+        begin = target.latest(uid) or since
+        rows = toRows(source.scan(uid, begin))
+        target.insert(rows)
+        copied += len(rows)
+    target.flush()
+
+    return copied
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""A script to mirror the local store (see storage.py) to and from BigQuery.
+
+    python sync.py pull [UniqueId ...]  # BigQuery -> local store
+    python sync.py push [UniqueId ...]  # local store -> BigQuery
+
+Only rows newer than the latest TBTimestamp in the target are copied, per
+station. Without UniqueIds, all stations of the source are synced.
+"""
+
+import os
+import sys
+import logging
+
+from google.cloud import bigquery
+
+from storage import BigQueryStorage, LocalStorage, sync  # custom
+
+# logger setup ----------------------------------------------------------------
+logger = logging.getLogger('airmonitorSync')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter("%(asctime)s\t%(name)s\t%(levelname)s\t"
+                              "%(message)s")
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+# settings --------------------------------------------------------------------
+localStorePath = os.environ.get("AIRMONITOR_LOCAL_STORE", "airmonitor_store")
+dataset_id = "airmonitor"
+table_id = "airmonitor"  # push needs a table in airmonitorSchema
+read_id = "airmonitor"  # table/view to pull from, airmonitor_wide if narrow
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ["pull", "push"]:
+        sys.exit(__doc__)
+    direction = sys.argv[1]
+    stations = [int(uid) for uid in sys.argv[2:]] or None
+
+    # make sure right environment variable is set for google account creds
+    client = bigquery.Client()
+    table = client.get_table(client.dataset(dataset_id).table(table_id))
+    remote = BigQueryStorage(client, table,
+                             f"{client.project}.{dataset_id}.{read_id}")
+    local = LocalStorage(localStorePath)
+
+    if direction == "pull":
+        copied = sync(remote, local, stations)
+    else:
+        copied = sync(local, remote, stations)
+    logger.info("Copied %s rows (%s).", copied, direction)
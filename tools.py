@@ -5,6 +5,8 @@ import pandas as pd
 import plotly.graph_objs as go
 
 from query import Query  # custom
+from storage import Storage  # custom
+from quality import qualityFilter  # custom
 from pandas.io import gbq  # for running queries
 
 from typing import Tuple, Optional, Union  # for typing support
@@ -15,13 +17,21 @@ def read_ts(data: Union[list, str],
             begin: Optional[dt.datetime] = None,
             end: Optional[dt.datetime] = None,
             query: Union[str, Query, None] = None,
-            resample_rule: str = "12H") -> Tuple[dict]:
+            resample_rule: str = "12H",
+            table: str = "exeter-science-unit.airmonitor.airmonitor",
+            storage: Optional[Storage] = None,
+            dropSpikes: bool = False) -> Tuple[dict]:
     """Read timeseries for given data/sensor labels and return in raw/resampled
     form.
 
     data should contain all the values to either be queried automagically or
     the key name of the resulting data in the output dict for a given query.
     If query is given, use the given query instead of the prebuilt one.
+    table is the table (or view, e.g. airmonitor_wide for the narrow layout,
+    see layout.py) the prebuilt query reads from. If storage is given (e.g.
+    storage.LocalStorage), the data is read from there instead of BigQuery.
+    If dropSpikes is set, the prebuilt query filters on QualityFlags (see
+    quality.py) and also drops the values flagged as spikes.
     """
     # sanitizing
     data = data if isinstance(data, list) else [data]
@@ -37,13 +47,17 @@ def read_ts(data: Union[list, str],
     # iterate over all elements in data
     for sl in data:  # sl = SensorLabel
         print(f"Working on {sl}-dataset...")
+        end = dt.datetime.now(tz=dt.timezone.utc)
+
         # create query object
-        if not query:
-            end = dt.datetime.now(tz=dt.timezone.utc)
+        if storage is not None and not query:
+            q = None
+        elif not query:
+            valid = (qualityFilter(sl) if dropSpikes else
+                     f"{sl}_Status = 'Valid' AND {sl}_Scaled >= 0")
             q = Query(SELECT=f"TBTimestamp AS ts, {sl}_Scaled AS {sl}_ts",
-                      FROM="`exeter-science-unit.airmonitor.airmonitor`",
-                      WHERE=f"UniqueID = {stationID} AND {sl}_Status = 'Valid'"
-                            f" AND {sl}_Scaled >= 0"
+                      FROM=f"`{table}`",
+                      WHERE=f"UniqueID = {stationID} AND {valid}"
                             f" AND TBTimestamp >= '{begin}'"
                             f" AND TBTimestamp <= '{end}'",
                       ORDERBY="ts")
@@ -51,7 +65,10 @@ def read_ts(data: Union[list, str],
             q = query
 
         # read data
-        dfs[sl] = gbq.read_gbq(str(q), dialect='standard')
+        if q is None:
+            dfs[sl] = storage.read(sl, stationID, begin, end, dropSpikes)
+        else:
+            dfs[sl] = gbq.read_gbq(str(q), dialect='standard')
 
         # transform timestamps to datetime and set index to datetime
         dfs[sl].ts = pd.to_datetime(dfs[sl].ts)